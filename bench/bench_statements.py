@@ -0,0 +1,109 @@
+# Микробенчмарк горячих запросов: сколько стоит один вызов, если каждый раз слать текст
+# (parse + plan на сервере), и через кэш операторов asyncpg, которым пользуется пул бота.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/luminary_bench python bench/bench_statements.py
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+USER_ID = 20_000_000
+AUDIENCE = list(range(USER_ID, USER_ID + 500))
+
+def hot_paths(main):
+    # (обработчик или задание, запрос, метод, параметры)
+    return {
+        "add_*_save": (main.SQL_SAVE_ENTRIES, "execute", ([USER_ID], ["bench"], ["free"], main.DEFAULT_TIMEZONE)),
+        "show_*": (main.SQL_PAGE_LATEST, "fetch", (USER_ID, "free", main.PAGE_MAX_ROWS + 1)),
+        "summary": (main.SQL_SUMMARY, "fetchrow", (USER_ID, main.DEFAULT_TIMEZONE)),
+        "user_profile": (main.SQL_USER_PROFILE, "fetchrow", (USER_ID,)),
+        "fsm_load": (main.SQL_FSM_LOAD, "fetchrow", (f"bench:{USER_ID}",)),
+        "broadcast_plan_cursors": (main.SQL_LOAD_CURSORS, "fetch", ("affirmations", AUDIENCE)),
+        "broadcast_plan_signups": (main.SQL_SIGNUP_TIMES, "fetch", (AUDIENCE,)),
+    }
+
+async def seed(main):
+    await main.init_pool()
+    try:
+        await main.init_db()
+        await main.execute_query("""
+            INSERT INTO users (user_id, username, timezone)
+            SELECT id, 'bench', $2 FROM unnest($1::bigint[]) AS id
+            ON CONFLICT (user_id) DO NOTHING
+        """, AUDIENCE, main.DEFAULT_TIMEZONE)
+        for _ in range(50):
+            await main.save_entry(USER_ID, "bench", "free")
+    finally:
+        await main.close_pool()
+
+async def measure(call, iterations):
+    for _ in range(min(50, iterations)):
+        await call()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 1),
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 1),
+        "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1),
+    }
+
+async def run(args):
+    import asyncpg
+    import main
+
+    await seed(main)
+    url = main.DATABASE_URL
+    # text: кэш asyncpg выключен — каждый вызов заново разбирается и планируется сервером
+    connections = {
+        "text": await asyncpg.connect(url, statement_cache_size=0),
+        "asyncpg_cache": await asyncpg.connect(url),
+    }
+    results = {}
+    try:
+        for path, (query, method, params) in hot_paths(main).items():
+            results[path] = {"statement": query.name}
+            for mode, conn in connections.items():
+                call = lambda: getattr(conn, method)(str(query), *params)
+                results[path][mode] = await measure(call, args.iterations)
+            row = results[path]
+            print(
+                f"{path:<24} text={row['text']['p50_us']:>8}µs "
+                f"cache={row['asyncpg_cache']['p50_us']:>8}µs"
+            )
+    finally:
+        for conn in connections.values():
+            await conn.close()
+    return {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "iterations": args.iterations,
+        "paths": results,
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Per-call cost of the hot SQL statements")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        sys.exit("BENCH_DATABASE_URL is required")
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    report = asyncio.run(run(args))
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main_cli()
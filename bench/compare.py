@@ -0,0 +1,49 @@
+# Сравнение двух отчётов run_bench.py:
+#   python bench/compare.py bench/results/<old>.json bench/results/<new>.json
+import json
+import sys
+
+# (путь в отчёте, меньше — лучше)
+HANDLER_METRICS = (
+    (("handlers", "updates_per_s"), False),
+    (("handlers", "latency", "p50_ms"), True),
+    (("handlers", "latency", "p99_ms"), True),
+)
+JOB_METRICS = (
+    ("enqueue_s", True),
+    ("deliver_s", True),
+    ("messages_per_s", False),
+)
+
+def dig(report, path):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+def format_row(name, old, new, lower_is_better):
+    if old is None or new is None:
+        return f"{name:<40} {old!s:>10} {new!s:>10}"
+    change = (new - old) / old * 100 if old else 0.0
+    better = change < 0 if lower_is_better else change > 0
+    mark = "" if abs(change) < 5 else ("✅" if better else "❌")
+    return f"{name:<40} {old:>10} {new:>10} {change:>+8.1f}% {mark}"
+
+def compare(old, new):
+    print(f"{'':<40} {old['commit']:>10} {new['commit']:>10}")
+    for path, lower_is_better in HANDLER_METRICS:
+        print(format_row(".".join(path), dig(old, path), dig(new, path), lower_is_better))
+    for step in sorted(set(dig(old, ("handlers", "steps")) or {}) | set(dig(new, ("handlers", "steps")) or {})):
+        path = ("handlers", "steps", step, "p99_ms")
+        print(format_row(f"{step}.p99_ms", dig(old, path), dig(new, path), True))
+    for job in sorted(set(old.get("jobs", {})) | set(new.get("jobs", {}))):
+        for metric, lower_is_better in JOB_METRICS:
+            path = ("jobs", job, metric)
+            print(format_row(f"{job}.{metric}", dig(old, path), dig(new, path), lower_is_better))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: compare.py OLD.json NEW.json")
+    with open(sys.argv[1]) as old_file, open(sys.argv[2]) as new_file:
+        compare(json.load(old_file), json.load(new_file))
@@ -0,0 +1,157 @@
+# Локальная подмена Telegram Bot API для нагрузочных тестов.
+# Отвечает на getMe / getUpdates / sendMessage / editMessageText и т.п. так же, как настоящий
+# сервер, но с настраиваемой задержкой, искусственными 429 и «заблокировавшими» бота чатами.
+# Ответы бота складываются в очередь своего чата — генератор нагрузки ждёт их оттуда.
+import asyncio
+import itertools
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_every=0, retry_after=1, blocked=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.stats = defaultdict(int)
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self._replies = defaultdict(asyncio.Queue)
+        self._send_calls = 0
+
+    # --- сторона пользователя (генератор нагрузки)
+
+    def push_message(self, chat_id, text):
+        self._push({
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+                "text": text,
+            }
+        })
+
+    def push_callback(self, chat_id, data, message_id):
+        self._push({
+            "callback_query": {
+                "id": str(next(self._message_ids)),
+                "chat_instance": str(chat_id),
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": "",
+                },
+                "data": data,
+            }
+        })
+
+    def _push(self, update):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self.stats["updates"] += 1
+        self._new_updates.set()
+
+    async def next_reply(self, chat_id, timeout=30):
+        return await asyncio.wait_for(self._replies[chat_id].get(), timeout)
+
+    # --- сторона бота (HTTP)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        handler = getattr(self, f"api_{method.lower()}", None)
+        if handler is None:
+            return self._ok(True)
+        return await handler(params)
+
+    def _ok(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, code, description, **parameters):
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def _delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def _message(self, chat_id, text, message_id=None):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    async def api_getme(self, params):
+        return self._ok(BOT_USER)
+
+    async def api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        # Подтверждённые апдейты больше не отдаём — как настоящий long polling
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._ok(self._updates[:limit])
+
+    async def api_sendmessage(self, params):
+        await self._delay()
+        chat_id = int(params["chat_id"])
+        self._send_calls += 1
+        if self.rate_limit_every and self._send_calls % self.rate_limit_every == 0:
+            self.stats["rate_limited"] += 1
+            return self._error(
+                429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+            )
+        if chat_id in self.blocked:
+            self.stats["blocked"] += 1
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        self.stats["sent"] += 1
+        message = self._message(chat_id, params.get("text", ""))
+        self._replies[chat_id].put_nowait(message)
+        return self._ok(message)
+
+    async def api_editmessagetext(self, params):
+        await self._delay()
+        chat_id = int(params["chat_id"])
+        self.stats["edited"] += 1
+        message = self._message(chat_id, params.get("text", ""), int(params["message_id"]))
+        self._replies[chat_id].put_nowait(message)
+        return self._ok(message)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        return runner, f"http://{host}:{port}"
@@ -0,0 +1,287 @@
+# Нагрузочный прогон бота целиком: настоящий роутер, FSM, Postgres и outbox,
+# вместо Telegram — локальный fake_bot_api.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/luminary_bench python bench/run_bench.py --users 200
+#   python bench/compare.py bench/results/<old>.json bench/results/<new>.json
+#
+# База должна быть отдельной: перед прогоном таблицы бота очищаются.
+# Отчёт пишется в bench/results/<commit>-<время>.json.
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+RESULTS_DIR = BENCH_DIR / "results"
+
+BENCH_TABLES = ("entries", "users", "user_stats", "content_cursors", "outbox", "broadcast_runs", "fsm_states")
+
+# Путь одного пользователя: (шаг, апдейт). Каждый шаг ждёт ровно один ответ бота
+ADD_FLOWS = (
+    ("add_achievement", "🌱 Добавить достижение", "Сделал(а) зарядку"),
+    ("add_gratitude", "🤍 Добавить благодарность себе", "Спасибо себе за терпение"),
+    ("add_entry", "✍️ Добавить запись", "Сегодня был длинный, но хороший день"),
+)
+SHOW_VIEWS = (
+    ("show_achievements", "🌱 Мои достижения"),
+    ("show_gratitudes", "🤍 Мои благодарности"),
+    ("show_entries", "📜 Мои записи"),
+)
+
+def user_script(index, entries_per_flow):
+    yield "start", "/start"
+    yield "name", f"Имя{index}"
+    for flow, button, text in ADD_FLOWS:
+        for n in range(entries_per_flow):
+            yield f"{flow}_start", button
+            yield f"{flow}_save", f"{text} #{n + 1}"
+    for view, button in SHOW_VIEWS:
+        yield view, button
+    yield "summary", "/summary"
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+def latency_summary(samples):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50_ms": percentile(ordered, 0.50),
+        "p99_ms": percentile(ordered, 0.99),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit, bool(git("status", "--porcelain", "--untracked-files=no"))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load benchmark against a local fake Bot API")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50, help="simultaneously active users")
+    parser.add_argument("--entries", type=int, default=2, help="entries per add_* flow and user")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake Bot API latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth sendMessage with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=float, default=0.05, help="share of users that blocked the bot")
+    parser.add_argument("--broadcast-rate", type=float, default=1000.0, help="messages/s, overrides BROADCAST_RATE")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a single reply")
+    parser.add_argument("--output", type=Path, help="report path (default bench/results/<commit>-<ts>.json)")
+    return parser.parse_args()
+
+def configure_env(args):
+    # До импорта main: он читает окружение при загрузке модуля
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        sys.exit("BENCH_DATABASE_URL is required (the benchmark truncates the bot tables)")
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["BOT_TOKEN"] = "123456:BENCH"
+    os.environ["BROADCAST_RATE"] = str(args.broadcast_rate)
+    os.environ["BROADCAST_BURST"] = str(max(1, int(args.broadcast_rate)))
+    # Задания идут подряд по тем же чатам — пауза между сообщениями в один чат мерила бы саму себя
+    os.environ.setdefault("BROADCAST_PER_CHAT_INTERVAL", "0")
+    os.environ.setdefault("OUTBOX_POLL_INTERVAL", "0.05")
+    os.environ.setdefault("SLOW_QUERY_MS", "1000")
+    sys.path.insert(0, str(REPO_DIR))
+    sys.path.insert(0, str(BENCH_DIR))
+
+class Bench:
+    def __init__(self, args, main, fake):
+        self.args = args
+        self.main = main
+        self.fake = fake
+        self.user_ids = [10_000_000 + index for index in range(args.users)]
+        self.step_latency = {}
+        self.timeouts = 0
+
+    async def reset_db(self):
+        await self.main.execute_query(f"TRUNCATE {', '.join(BENCH_TABLES)}")
+
+    async def run_user(self, index, user_id, semaphore):
+        async with semaphore:
+            for step, text in user_script(index, self.args.entries):
+                started = time.perf_counter()
+                self.fake.push_message(user_id, text)
+                try:
+                    await self.fake.next_reply(user_id, self.args.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    print(f"⚠️ No reply to {step} for {user_id}")
+                    return
+                self.step_latency.setdefault(step, []).append(time.perf_counter() - started)
+
+    async def run_users(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        updates_before = self.fake.stats["updates"]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            self.run_user(index, user_id, semaphore) for index, user_id in enumerate(self.user_ids)
+        ))
+        elapsed = time.perf_counter() - started
+        updates = self.fake.stats["updates"] - updates_before
+        samples = [sample for step in self.step_latency.values() for sample in step]
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "updates": updates,
+            "updates_per_s": round(updates / elapsed, 1) if elapsed else 0.0,
+            "timeouts": self.timeouts,
+            "latency": latency_summary(samples),
+            "steps": {step: latency_summary(values) for step, values in self.step_latency.items()},
+        }
+
+    async def prepare_job(self, name, today):
+        main = self.main
+        now = datetime.utcnow()
+        await main.execute_query("UPDATE users SET delivery_status = 'active'")
+        if name == "affirmations":
+            await main.execute_query("UPDATE users SET next_affirmation_at = $1", now - timedelta(minutes=1))
+        elif name == "evening_questions":
+            await main.execute_query("UPDATE users SET next_question_at = $1", now - timedelta(minutes=1))
+        elif name == "breathing":
+            await main.execute_query("UPDATE users SET last_entry_at = $1", now - timedelta(days=8))
+        elif name == "anniversary":
+            starts, _ = main.local_day_bounds(main.anniversary_days(today)[:1])
+            await main.execute_query("UPDATE users SET created_at = $1", starts[0] + timedelta(hours=12))
+        elif name == "monthly":
+            starts, _ = main.local_day_bounds([today - timedelta(days=main.FIRST_MONTH_DAYS)])
+            await main.execute_query("UPDATE users SET created_at = $1", starts[0] + timedelta(hours=12))
+
+    async def run_job(self, name, job):
+        main = self.main
+        today = datetime.fromisoformat(main.today_run_key()).date()
+        await self.prepare_job(name, today)
+        sent_before = dict(self.fake.stats)
+        started = time.perf_counter()
+        await job()
+        enqueued = time.perf_counter()
+        # Воркеры outbox начинают доставку ещё во время постановки в очередь
+        queued = await main.fetch_value("SELECT COUNT(*) FROM outbox")
+        while await main.fetch_value("SELECT COUNT(*) FROM outbox WHERE status = 'pending'"):
+            await asyncio.sleep(0.02)
+        finished = time.perf_counter()
+        delivered = {
+            key: self.fake.stats[key] - sent_before.get(key, 0) for key in ("sent", "blocked", "rate_limited")
+        }
+        failed = await main.fetch_value("SELECT COUNT(*) FROM outbox WHERE status = 'failed'")
+        await main.execute_query("DELETE FROM outbox")
+        total_s = finished - started
+        return {
+            "queued": queued,
+            "enqueue_s": round(enqueued - started, 3),
+            "deliver_s": round(finished - enqueued, 3),
+            "total_s": round(total_s, 3),
+            "messages_per_s": round((delivered["sent"] + delivered["blocked"]) / total_s, 1) if total_s else 0.0,
+            "failed": failed,
+            **delivered,
+        }
+
+    async def run_jobs(self):
+        main = self.main
+        jobs = {
+            "affirmations": main.send_daily_affirmation,
+            "evening_questions": main.send_evening_question,
+            "breathing": main.send_breathing_reminder,
+            "anniversary": main.send_anniversary,
+            "monthly": main.send_monthly_gratitude,
+        }
+        blocked = int(len(self.user_ids) * self.args.blocked)
+        # Заблокировавшие бота — только для рассылок: на ответы обработчиков они не влияют
+        self.fake.blocked = set(self.user_ids[:blocked])
+        results = {}
+        for name, job in jobs.items():
+            results[name] = await self.run_job(name, job)
+            print(
+                f"📬 {name}: queued={results[name]['queued']} enqueue={results[name]['enqueue_s']}s "
+                f"deliver={results[name]['deliver_s']}s ({results[name]['messages_per_s']} msg/s)"
+            )
+        self.fake.blocked = set()
+        await main.execute_query("UPDATE users SET delivery_status = 'active'")
+        return results
+
+async def run(args):
+    import main
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from fake_bot_api import FakeBotAPI
+
+    fake = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter,
+        rate_limit_every=args.rate_limit_every, retry_after=args.retry_after
+    )
+    api_runner, base_url = await fake.start()
+    await main.init_pool()
+    await main.init_db()
+    bench = Bench(args, main, fake)
+    await bench.reset_db()
+
+    bot = Bot(main.BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    dp = Dispatcher(storage=main.create_fsm_storage())
+    dp.include_router(main.router)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    main.outbox_dispatcher = main.OutboxDispatcher(bot)
+    main.outbox_dispatcher.start()
+    if main.ENTRY_BATCHING:
+        main.entry_batcher = main.EntryBatcher()
+        main.entry_batcher.start()
+    try:
+        print(f"🏃 {args.users} users, concurrency {args.concurrency}")
+        handlers = await bench.run_users()
+        print(
+            f"⏱ {handlers['updates']} updates in {handlers['elapsed_s']}s ({handlers['updates_per_s']} upd/s), "
+            f"p50={handlers['latency']['p50_ms']}ms p99={handlers['latency']['p99_ms']}ms"
+        )
+        jobs = await bench.run_jobs()
+    finally:
+        await dp.stop_polling()
+        await asyncio.wait_for(polling, 5)
+        if main.entry_batcher is not None:
+            await main.entry_batcher.close()
+        await main.outbox_dispatcher.close()
+        await bot.session.close()
+        await main.close_pool()
+        await api_runner.cleanup()
+
+    commit, dirty = git_revision()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "config": {
+            **{key: (str(value) if isinstance(value, Path) else value) for key, value in vars(args).items()},
+            "entry_batching": main.ENTRY_BATCHING,
+        },
+        "handlers": handlers,
+        "jobs": jobs,
+        "queries": [
+            {key: value for key, value in row.items() if key != "last_plan"}
+            for row in main.get_query_profile(15)
+        ],
+    }
+
+def main_cli():
+    args = parse_args()
+    configure_env(args)
+    report = asyncio.run(run(args))
+    output = args.output
+    if output is None:
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        output = RESULTS_DIR / f"{report['commit']}{'-dirty' if report['dirty'] else ''}-{stamp}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"📝 Report written to {output}")
+
+if __name__ == "__main__":
+    main_cli()
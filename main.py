@@ -1,44 +1,42 @@
 import asyncio
+import bisect
+import calendar
+import copy
+import functools
 import os
 import random
+import re
+import signal
 import hashlib
-import threading
-from datetime import datetime, timedelta
+import json
+import math
+import sys
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import aclosing, asynccontextmanager, suppress
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNetworkError, TelegramServerError
+)
 from aiogram.types import (
-    Message, ReplyKeyboardMarkup, KeyboardButton
+    Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton
 )
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 import pytz
 
-# === HEALTH CHECK ===
-from aiohttp import web
-
-async def health_check(request):
-    return web.Response(text="OK")
-
-def start_health_server():
-    async def run_server():
-        app = web.Application()
-        app.router.add_get('/health', health_check)
-        runner = web.AppRunner(app)
-        await runner.setup()
-        port = int(os.getenv("PORT", 10000))
-        site = web.TCPSite(runner, "0.0.0.0", port)
-        await site.start()
-        await asyncio.Event().wait()
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_server())
-
-threading.Thread(target=start_health_server, daemon=True).start()
-
 # === ОСНОВНОЙ КОД ===
 load_dotenv()
 
@@ -49,12 +47,474 @@ if not BOT_TOKEN:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is required")
 
+# === МЕТРИКИ ===
+# Счётчики и гистограммы в памяти процесса, отдаются на /metrics в текстовом формате
+# Prometheus. Запись — пара операций со словарём, поэтому включены всегда.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_DB_GAUGES_TTL = float(os.getenv("METRICS_DB_GAUGES_TTL", "30"))
+METRICS_MAX_SERIES = 500  # на метрику: защита от взрыва числа меток
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._series = {}
+        METRICS.append(self)
+
+    def _key(self, label_values):
+        if label_values not in self._series and len(self._series) >= METRICS_MAX_SERIES:
+            return ("other",) * len(self.labels)
+        return label_values
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._render_series())
+        return lines
+
+    def _render_series(self):
+        for label_values, value in self._series.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        self._series[key] = self._series.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self._series[self._key(label_values)] = value
+
+    def replace(self, values):
+        self._series = dict(values)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        series = self._series.get(key)
+        if series is None:
+            # [счётчики по корзинам..., +Inf], сумма
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def _render_series(self):
+        for label_values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+METRICS = []
+
+handler_latency = Histogram(
+    "bot_handler_duration_seconds", "Update handling time per handler", ("handler",)
+)
+handler_errors = Counter("bot_handler_errors_total", "Exceptions raised by handlers", ("handler",))
+db_query_duration = Histogram(
+    "bot_db_query_duration_seconds", "Query execution time per statement", ("statement",)
+)
+db_query_errors = Counter("bot_db_query_errors_total", "Query errors per statement", ("statement",))
+broadcast_queued = Counter("bot_broadcast_queued_total", "Messages queued to the outbox per job", ("job",))
+broadcast_duration = Histogram(
+    "bot_broadcast_duration_seconds", "Time to queue a broadcast run per job", ("job",), buckets=JOB_BUCKETS
+)
+broadcast_messages = Counter(
+    "bot_broadcast_messages_total", "Outbox delivery results per job", ("job", "result")
+)
+db_pool_gauge = Gauge("bot_db_pool", "Database connection pool statistics", ("stat",))
+profile_cache_gauge = Gauge("bot_profile_cache", "User profile cache statistics", ("stat",))
+fsm_states_gauge = Gauge("bot_fsm_states", "Users in each FSM state", ("state",))
+outbox_backlog_gauge = Gauge("bot_outbox_pending", "Messages waiting in the outbox")
+entry_batch_rows = Histogram(
+    "bot_entry_batch_rows", "Journal entries written per group commit", buckets=BATCH_BUCKETS
+)
+entry_batch_flush = Histogram("bot_entry_batch_flush_seconds", "Time to write one group commit of entries")
+entry_batch_wait = Histogram(
+    "bot_entry_batch_wait_seconds", "Time from queueing an entry to its group commit"
+)
+
+# Отпечаток оператора — SQL без лишних пробелов и литералов. Метка: имя из реестра
+# запросов, а для остальных — глагол, первая таблица и короткий хэш отпечатка
+STATEMENT_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+([a-z_]+)", re.IGNORECASE)
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?\b")
+SQL_WRITE_RE = re.compile(r"\b(?:INSERT|UPDATE|DELETE|MERGE|CREATE|ALTER|DROP|TRUNCATE|LOCK|COPY)\b", re.IGNORECASE)
+
+Statement = namedtuple("Statement", "label normalized read_only")
+_statements = {}
+
+def describe_statement(query):
+    statement = _statements.get(query)
+    if statement is None:
+        normalized = SQL_LITERAL_RE.sub("?", " ".join(query.split()))
+        verb = normalized.split(" ", 1)[0].lower() or "empty"
+        table = STATEMENT_TABLE_RE.search(normalized)
+        digest = hashlib.sha1(normalized.encode()).hexdigest()[:6]
+        statement = Statement(
+            getattr(query, "name", None) or f"{verb}:{table.group(1).lower() if table else '-'}:{digest}",
+            normalized,
+            verb in ("select", "with") and not SQL_WRITE_RE.search(normalized),
+        )
+        if len(_statements) < METRICS_MAX_SERIES:
+            _statements[query] = statement
+    return statement
+
+async def metrics_middleware(handler, event, data):
+    name = data["handler"].callback.__name__
+    operation = current_operation.set(f"handler {name}")
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+    finally:
+        handler_latency.observe(time.perf_counter() - started, name)
+        current_operation.reset(operation)
+
+_db_gauges_updated = 0.0
+
+async def collect_db_gauges():
+    # Запросы к базе на каждый скрейп не нужны: обновляем не чаще METRICS_DB_GAUGES_TTL
+    global _db_gauges_updated
+    if time.monotonic() - _db_gauges_updated < METRICS_DB_GAUGES_TTL:
+        return
+    _db_gauges_updated = time.monotonic()
+    if FSM_STORAGE == "postgres":
+        rows = await fetch_all("SELECT state, COUNT(*) AS users FROM fsm_states WHERE state IS NOT NULL GROUP BY 1")
+        fsm_states_gauge.replace({(row["state"],): row["users"] for row in rows})
+    outbox_backlog_gauge.set(await fetch_value("SELECT COUNT(*) FROM outbox WHERE status = 'pending'"))
+
+async def render_metrics():
+    for stat, value in get_pool_stats().items():
+        db_pool_gauge.set(value, stat)
+    for stat, value in get_profile_cache_stats().items():
+        profile_cache_gauge.set(value, stat)
+    try:
+        await collect_db_gauges()
+    except Exception as exc:
+        print(f"Metrics collection error: {exc}")
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# === ПРОФИЛИРОВАНИЕ ЗАПРОСОВ ===
+# Каждый запрос через _run_query попадает в профиль своего оператора (отпечаток —
+# нормализованный SQL): скользящие p50/p95/p99 по последним QUERY_PROFILE_WINDOW вызовам.
+# Медленные пишутся в лог с формой параметров (не значениями — там тексты дневника),
+# хендлером или заданием и местом вызова; часть медленных чтений — с EXPLAIN ANALYZE.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+QUERY_PROFILE_WINDOW = int(os.getenv("QUERY_PROFILE_WINDOW", "1000"))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0"))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "600"))
+
+DB_HELPERS = {"_run_query", "record_query", "fetch_all", "fetch_one", "fetch_value", "execute_query", "execute_many"}
+
+# Хендлер или задание, от имени которого идут запросы: выставляют metrics_middleware,
+# run_broadcast и воркеры outbox
+current_operation = ContextVar("current_operation", default=None)
+
+@dataclass
+class QueryStats:
+    label: str
+    sql: str
+    calls: int = 0
+    errors: int = 0
+    slow: int = 0
+    total: float = 0.0
+    durations: deque = field(default_factory=lambda: deque(maxlen=QUERY_PROFILE_WINDOW))
+    last_explain: float = 0.0
+    last_plan: str = None
+
+    def snapshot(self):
+        ordered = sorted(self.durations)
+
+        def percentile(q):
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+        return {
+            "statement": self.label,
+            "calls": self.calls,
+            "errors": self.errors,
+            "slow": self.slow,
+            "total_ms": round(self.total * 1000, 1),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "sql": self.sql[:300],
+            "last_plan": self.last_plan,
+        }
+
+query_profile = {}
+
+def param_shape(value):
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    return type(value).__name__
+
+def call_site():
+    # Первый кадр за пределами обёрток над базой — там, откуда запрос на самом деле пришёл
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_name in DB_HELPERS:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+def record_query(statement, query, params, elapsed, failed):
+    stats = query_profile.get(statement.label)
+    if stats is None:
+        stats = query_profile[statement.label] = QueryStats(statement.label, statement.normalized)
+    stats.calls += 1
+    stats.errors += failed
+    stats.total += elapsed
+    stats.durations.append(elapsed)
+    if elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    stats.slow += 1
+    print(
+        f"🐢 Slow query {statement.label}: {elapsed * 1000:.0f} ms "
+        f"in {current_operation.get() or '-'} at {call_site()} "
+        f"params=({', '.join(param_shape(value) for value in params)}) "
+        f"sql={statement.normalized[:300]}"
+    )
+    now = time.monotonic()
+    if (
+        statement.read_only and not failed
+        and SLOW_QUERY_EXPLAIN_RATE > 0 and random.random() < SLOW_QUERY_EXPLAIN_RATE
+        and now - stats.last_explain > SLOW_QUERY_EXPLAIN_INTERVAL
+    ):
+        stats.last_explain = now
+        asyncio.create_task(explain_query(stats, query, params))
+
+async def explain_query(stats, query, params):
+    # ANALYZE выполняет запрос повторно, поэтому только чтения и только в read-only транзакции
+    try:
+        async with db_connection() as conn:
+            async with conn.transaction(readonly=True):
+                rows = await conn.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {query}", *params)
+        stats.last_plan = "\n".join(row[0] for row in rows)
+        print(f"🔬 Plan for {stats.label}:\n{stats.last_plan}")
+    except Exception as exc:
+        print(f"EXPLAIN for {stats.label} failed: {exc}")
+
+def get_query_profile(limit=20):
+    top = sorted(query_profile.values(), key=lambda stats: stats.total, reverse=True)[:limit]
+    return [stats.snapshot() for stats in top]
+
+def report_query_profile(limit=5):
+    for row in get_query_profile(limit):
+        print(
+            f"DB {row['statement']}: calls={row['calls']} errors={row['errors']} slow={row['slow']} "
+            f"total={row['total_ms']}ms p50={row['p50_ms']} p95={row['p95_ms']} p99={row['p99_ms']}"
+        )
+
 # === DATABASE ===
 import asyncpg
 
-async def init_db():
-    conn = await asyncpg.connect(DATABASE_URL)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+DB_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_HEALTH_CHECK_INTERVAL", "300"))
+
+db_pool = None  # создаётся один раз в main() через init_pool()
+
+# === ИМЕНОВАННЫЕ ЗАПРОСЫ ===
+# Горячие запросы обработчиков и рассылок живут в реестре под своими именами: имя становится
+# меткой в метриках и профиле запросов. Выполняются они обычным текстом — соединения пула
+# живут долго, и встроенный кэш операторов asyncpg готовит каждый запрос один раз на соединение.
+class NamedSql(str):
+    # Строка SQL с именем: годится везде, где ждут текст запроса (в asyncpg — через str())
+    name = None
+
+SQL_REGISTRY = {}
+
+def named_sql(name, query):
+    if name in SQL_REGISTRY:
+        raise ValueError(f"SQL {name!r} is already registered")
+    statement = NamedSql(query)
+    statement.name = name
+    SQL_REGISTRY[name] = statement
+    return statement
+
+pool_stats = {
+    "acquired": 0,
+    "acquire_timeouts": 0,
+    "acquire_wait_total": 0.0,
+    "acquire_wait_max": 0.0,
+    "health_checks": 0,
+    "health_failures": 0,
+}
+
+async def init_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        )
+    return db_pool
+
+async def close_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+@asynccontextmanager
+async def db_connection():
+    if db_pool is None:
+        raise RuntimeError("Database pool is not initialised, call init_pool() first")
+    started = time.monotonic()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats["acquire_timeouts"] += 1
+        raise
+    waited = time.monotonic() - started
+    pool_stats["acquired"] += 1
+    pool_stats["acquire_wait_total"] += waited
+    pool_stats["acquire_wait_max"] = max(pool_stats["acquire_wait_max"], waited)
+    try:
+        yield conn
+    finally:
+        await db_pool.release(conn)
+
+@asynccontextmanager
+async def schema_connection():
+    # DDL, миграции и CREATE INDEX CONCURRENTLY на большой таблице идут дольше DB_COMMAND_TIMEOUT —
+    # схему готовим на отдельном соединении без таймаута, иначе старт уходит в цикл падений
+    conn = await asyncpg.connect(DATABASE_URL, command_timeout=None)
     try:
+        yield conn
+    finally:
+        await conn.close()
+
+@asynccontextmanager
+async def db_transaction():
+    async with db_connection() as conn:
+        async with conn.transaction():
+            yield conn
+
+async def _execute(conn, method, query, params):
+    # asyncpg принимает только точный str
+    return await getattr(conn, method)(str(query), *params)
+
+async def _run_query(method, query, params, conn=None):
+    statement = describe_statement(query)
+    started = time.perf_counter()
+    failed = False
+    try:
+        if conn is not None:
+            return await _execute(conn, method, query, params)
+        async with db_connection() as conn:
+            return await _execute(conn, method, query, params)
+    except Exception:
+        failed = True
+        db_query_errors.inc(statement.label)
+        raise
+    finally:
+        # Для запросов без своего соединения сюда входит и ожидание пула
+        elapsed = time.perf_counter() - started
+        db_query_duration.observe(elapsed, statement.label)
+        record_query(statement, query, params, elapsed, failed)
+
+# Чтение: список строк / одна строка / одно значение
+async def fetch_all(query, *params, conn=None):
+    return await _run_query("fetch", query, params, conn)
+
+async def fetch_one(query, *params, conn=None):
+    return await _run_query("fetchrow", query, params, conn)
+
+async def fetch_value(query, *params, conn=None):
+    return await _run_query("fetchval", query, params, conn)
+
+# Запись: возвращает статус команды Postgres, например "UPDATE 1"
+async def execute_query(query, *params, conn=None):
+    return await _run_query("execute", query, params, conn)
+
+async def execute_many(query, args, conn=None):
+    return await _run_query("executemany", query, (args,), conn)
+
+def affected_rows(status):
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (AttributeError, ValueError):
+        return 0
+
+def get_pool_stats():
+    acquired = pool_stats["acquired"]
+    return {
+        "size": db_pool.get_size() if db_pool else 0,
+        "idle": db_pool.get_idle_size() if db_pool else 0,
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "acquired": acquired,
+        "acquire_timeouts": pool_stats["acquire_timeouts"],
+        "acquire_wait_avg_ms": round(pool_stats["acquire_wait_total"] / acquired * 1000, 2) if acquired else 0.0,
+        "acquire_wait_max_ms": round(pool_stats["acquire_wait_max"] * 1000, 2),
+        "health_checks": pool_stats["health_checks"],
+        "health_failures": pool_stats["health_failures"],
+    }
+
+async def check_db_health():
+    pool_stats["health_checks"] += 1
+    try:
+        async with db_connection() as conn:
+            await conn.fetchval("SELECT 1", timeout=5)
+        return True
+    except Exception as exc:
+        pool_stats["health_failures"] += 1
+        print(f"DB health check failed: {exc}")
+        return False
+
+async def report_db_health():
+    healthy = await check_db_health()
+    print(f"DB pool {'ok' if healthy else 'UNHEALTHY'}: {get_pool_stats()}")
+    print(f"Profile cache: {get_profile_cache_stats()}")
+    report_query_profile()
+
+async def init_db():
+    async with schema_connection() as conn:
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
@@ -65,6 +525,26 @@ async def init_db():
                 created_at TIMESTAMP DEFAULT NOW()
             )
         """)
+        # Доставка по местному времени пользователя: next_*_at — момент (UTC),
+        # когда пора отправить следующую аффирмацию / вечерний вопрос
+        await conn.execute("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS timezone TEXT,
+                ADD COLUMN IF NOT EXISTS next_affirmation_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS next_question_at TIMESTAMP
+        """)
+        # Денормализованная активность: обновляется вместе с каждой записью (save_entry),
+        # чтобы напоминание не сканировало entries
+        await conn.execute("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS last_entry_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS entry_count INT NOT NULL DEFAULT 0
+        """)
+        # Доставимость: active / blocked / deactivated / chat_not_found — по ответам Telegram
+        await conn.execute("""
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS delivery_status TEXT NOT NULL DEFAULT 'active'
+        """)
+        await conn.execute(SQL_CREATE_NEXT_LOCAL_TIME)
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS entries (
                 id SERIAL PRIMARY KEY,
@@ -74,729 +554,519 @@ async def init_db():
                 entry_type TEXT DEFAULT 'free'
             )
         """)
+        # История отправок больше не пишется: её заменили курсоры ротации
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS sent_affirmations (
-                user_id BIGINT,
-                affirmation_hash TEXT,
-                sent_at TIMESTAMP DEFAULT NOW()
+            CREATE TABLE IF NOT EXISTS content_cursors (
+                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                catalog TEXT NOT NULL,
+                cycle_size INT NOT NULL,
+                start_index INT NOT NULL,
+                step INT NOT NULL,
+                position INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, catalog)
             )
         """)
+        # Отпечаток набора id, по которому строилась перестановка (см. ContentCatalog.signature)
+        await conn.execute("""
+            ALTER TABLE content_cursors ADD COLUMN IF NOT EXISTS cycle_signature BIGINT
+        """)
+        # Счётчики для /summary: обновляются в одной транзакции с каждой записью (save_entry).
+        # streak_day / week_start — местный день последней записи и неделя, к которой относится week_entries
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS sent_questions (
-                user_id BIGINT,
-                question_hash TEXT,
-                sent_at TIMESTAMP DEFAULT NOW()
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                achievements INT NOT NULL DEFAULT 0,
+                gratitudes INT NOT NULL DEFAULT 0,
+                free_entries INT NOT NULL DEFAULT 0,
+                here_and_now_entries INT NOT NULL DEFAULT 0,
+                first_entry_at TIMESTAMP,
+                streak_day DATE,
+                current_streak INT NOT NULL DEFAULT 0,
+                longest_streak INT NOT NULL DEFAULT 0,
+                week_start DATE,
+                week_entries INT NOT NULL DEFAULT 0
             )
         """)
-    finally:
-        await conn.close()
+        # Запуски рассылок с контрольной точкой: last_user_id — до кого уже дошли
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_runs (
+                job TEXT NOT NULL,
+                run_key TEXT NOT NULL,
+                started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP,
+                last_user_id BIGINT,
+                sent INT NOT NULL DEFAULT 0,
+                failed INT NOT NULL DEFAULT 0,
+                blocked INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (job, run_key)
+            )
+        """)
+        # Очередь исходящих сообщений: рассылки пишут сюда, доставляют воркеры OutboxDispatcher.
+        # not_before у ожидающей строки — и отложенная отправка, и аренда: взятая воркером
+        # строка сдвигается в будущее и вернётся в очередь сама, если воркер упал
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                priority SMALLINT NOT NULL DEFAULT 0,
+                not_before TIMESTAMP NOT NULL,
+                job TEXT NOT NULL,
+                run_key TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS queued INT NOT NULL DEFAULT 0
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        await run_migrations(conn)
+        await ensure_indexes(conn)
+
+# Ближайший момент (UTC, строго после after_utc), когда в поясе tz наступит local_time
+SQL_CREATE_NEXT_LOCAL_TIME = """
+    CREATE OR REPLACE FUNCTION next_local_time(tz TEXT, local_time TIME, after_utc TIMESTAMP)
+    RETURNS TIMESTAMP LANGUAGE sql STABLE AS $$
+        SELECT CASE
+            WHEN ((d + local_time) AT TIME ZONE tz) AT TIME ZONE 'UTC' > after_utc
+                THEN ((d + local_time) AT TIME ZONE tz) AT TIME ZONE 'UTC'
+            ELSE ((d + 1 + local_time) AT TIME ZONE tz) AT TIME ZONE 'UTC'
+        END
+        FROM (SELECT ((after_utc AT TIME ZONE 'UTC') AT TIME ZONE tz)::date AS d) AS local_day
+    $$
+"""
+
+async def run_migrations(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    for name, migration in MIGRATIONS:
+        async with conn.transaction():
+            # Несколько процессов могут стартовать одновременно — миграции идут по очереди
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+            if await conn.fetchval("SELECT 1 FROM schema_migrations WHERE name = $1", name):
+                continue
+            await migration(conn)
+            await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1)", name)
+            print(f"🗃 Applied migration {name}")
+
+# Кому вообще можно писать: не просил тишины и не заблокировал бота.
+# Входит во все аудитории рассылок и в предикаты их частичных индексов
+REACHABLE_USERS = "silence_until IS NULL AND delivery_status = 'active'"
+
+# Вторичные индексы под горячие запросы (см. HOT_QUERIES ниже)
+DB_INDEXES = {
+    "idx_entries_user_type_created_id": "entries (user_id, entry_type, created_at, id)",
+    "idx_fsm_states_updated": "fsm_states (updated_at)",
+    # Аудитории рассылок: частичные индексы только по тем, кому можно писать
+    "idx_users_reachable_affirmation": f"users (next_affirmation_at) WHERE {REACHABLE_USERS}",
+    "idx_users_reachable_question": f"users (next_question_at) WHERE {REACHABLE_USERS}",
+    "idx_users_reachable_inactive": f"users (last_entry_at) WHERE {REACHABLE_USERS}",
+    "idx_users_reachable_signup": f"users (created_at) WHERE {REACHABLE_USERS}",
+    "idx_users_silenced": "users (silence_until) WHERE silence_until IS NOT NULL",
+    "idx_outbox_pending": "outbox (priority DESC, not_before, id) WHERE status = 'pending'",
+    "idx_outbox_finished": "outbox (finished_at) WHERE status <> 'pending'",
+}
+
+# Заменённые индексы: удаляются после того, как построены новые
+DROPPED_INDEXES = (
+    "idx_entries_user_type_created",
+    "idx_entries_user_created",
+    # Ни один горячий запрос не фильтрует entries по одному created_at — только лишняя запись
+    "idx_entries_created",
+    "idx_users_next_affirmation",
+    "idx_users_next_question",
+    "idx_users_last_entry",
+    "idx_users_created",
+    "idx_users_due_affirmation",
+    "idx_users_due_question",
+    "idx_users_inactive",
+    "idx_users_signup",
+    # История отправок теперь в content_cursors — по sent_* горячих запросов больше нет
+    "idx_sent_affirmations_user_sent",
+    "idx_sent_questions_user_sent",
+)
 
-async def execute_query(query, *params):
-    conn = await asyncpg.connect(DATABASE_URL)
+async def ensure_indexes(conn):
+    # CONCURRENTLY не блокирует запись в таблицы, поэтому безопасно при каждом старте.
+    # Прерванная сборка оставляет невалидный индекс — его пересоздаём.
+    for name, definition in DB_INDEXES.items():
+        valid = await conn.fetchval("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = $1
+        """, name)
+        if valid:
+            continue
+        if valid is False:
+            await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+        print(f"🗂 Created index {name}")
+    for name in DROPPED_INDEXES:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+# === КАТАЛОГ КОНТЕНТА ===
+# Аффирмации и вечерние вопросы живут в content/catalog.json. У каждого элемента
+# постоянный id (SMALLINT): удалённые id не переиспользуются, новые добавляются в конец.
+CONTENT_CATALOG_PATH = os.getenv(
+    "CONTENT_CATALOG_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "catalog.json")
+)
+CATALOG_NAMES = ("affirmations", "evening_questions")
+SMALLINT_MAX = 32767
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+class ContentCatalog:
+    def __init__(self, name, version, items):
+        self.name = name
+        self.version = version
+        self.ids = sorted(items)
+        self.texts = dict(items)
+        # Курсор ротации хранит позицию в self.ids (по возрастанию id), поэтому порядок в файле
+        # не важен. А вот замена элемента при том же размере сдвигает позиции — подпись набора id
+        # это замечает, и курсор начинает новый цикл
+        self.signature = int.from_bytes(
+            hashlib.sha256(",".join(map(str, self.ids)).encode()).digest()[:8], "big", signed=True
+        )
+        # Старая история хранила sha256-префикс текста — индекс нужен для миграций
+        self.id_by_hash = {content_hash(text): item_id for item_id, text in items.items()}
+        self.position_by_id = {item_id: position for position, item_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def text_at(self, position):
+        return self.texts[self.ids[position]]
+
+def load_catalogs(path=CONTENT_CATALOG_PATH):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    version = data.get("version")
+    catalogs = {}
+    for name in CATALOG_NAMES:
+        items = {}
+        for item in data.get(name, []):
+            item_id, text = item.get("id"), (item.get("text") or "").strip()
+            if not isinstance(item_id, int) or not 0 < item_id <= SMALLINT_MAX:
+                raise ValueError(f"{name}: id {item_id!r} must be an integer in 1..{SMALLINT_MAX}")
+            if item_id in items:
+                raise ValueError(f"{name}: duplicate id {item_id}")
+            if not text:
+                raise ValueError(f"{name}: item {item_id} has no text")
+            items[item_id] = text
+        if not items:
+            raise ValueError(f"{name}: catalog is empty")
+        catalogs[name] = ContentCatalog(name, version, items)
+    return catalogs
+
+content_catalogs = load_catalogs()
+
+def reload_catalogs():
+    # Подмена словаря целиком атомарна: рассылка в процессе дочитает старую версию
+    global content_catalogs
     try:
-        if query.strip().upper().startswith("SELECT"):
-            return await conn.fetch(query, *params)
-        else:
-            await conn.execute(query, *params)
-    finally:
-        await conn.close()
+        catalogs = load_catalogs()
+    except (OSError, ValueError) as exc:
+        print(f"❌ Catalog reload failed, keeping version {content_catalogs['affirmations'].version}: {exc}")
+        return False
+    old_version = content_catalogs["affirmations"].version
+    content_catalogs = catalogs
+    sizes = ", ".join(f"{name}={len(catalog)}" for name, catalog in catalogs.items())
+    print(f"📚 Catalog reloaded: version {old_version} → {catalogs['affirmations'].version} ({sizes})")
+    return True
+
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+
+# === РОТАЦИЯ КОНТЕНТА ===
+# Каждому пользователю — своя перестановка каталога: индекс = (start + step * position) mod size,
+# где step взаимно прост с size. Следующий элемент считается за O(1) без чтения истории,
+# а внутри цикла элементы не повторяются.
+RotationCursor = namedtuple("RotationCursor", "user_id cycle_size cycle_signature start_index step position")
+
+SQL_LOAD_CURSORS = named_sql("load_rotation_cursors", """
+    SELECT user_id, cycle_size, cycle_signature, start_index, step, position
+    FROM content_cursors
+    WHERE catalog = $1 AND user_id = ANY($2::bigint[])
+""")
+
+SQL_SAVE_CURSORS = named_sql("save_rotation_cursors", """
+    INSERT INTO content_cursors (user_id, catalog, cycle_size, cycle_signature, start_index, step, position)
+    SELECT c.user_id, $1, c.cycle_size, c.cycle_signature, c.start_index, c.step, c.position
+    FROM unnest($2::bigint[], $3::int[], $4::bigint[], $5::int[], $6::int[], $7::int[])
+        AS c(user_id, cycle_size, cycle_signature, start_index, step, position)
+    ON CONFLICT (user_id, catalog) DO UPDATE SET
+        cycle_size = EXCLUDED.cycle_size,
+        cycle_signature = EXCLUDED.cycle_signature,
+        start_index = EXCLUDED.start_index,
+        step = EXCLUDED.step,
+        position = EXCLUDED.position
+""")
+
+def new_rotation(user_id, catalog, avoid=None):
+    size = len(catalog)
+    step = 1
+    if size > 2:
+        step = random.randrange(1, size)
+        while math.gcd(step, size) != 1:
+            step = random.randrange(1, size)
+    start = random.randrange(size)
+    # Новый цикл не начинаем с того, чем закончился предыдущий
+    if start == avoid and size > 1:
+        start = (start + 1) % size
+    return RotationCursor(user_id, size, catalog.signature, start, step, 0)
+
+def advance_rotation(cursor, user_id, catalog):
+    size = len(catalog)
+    if cursor is None or cursor.cycle_size != size or cursor.cycle_signature != catalog.signature:
+        cursor = new_rotation(user_id, catalog)
+    elif cursor.position >= size:
+        last = (cursor.start_index + cursor.step * (size - 1)) % size
+        cursor = new_rotation(user_id, catalog, avoid=last)
+    index = (cursor.start_index + cursor.step * cursor.position) % size
+    return index, cursor._replace(position=cursor.position + 1)
+
+async def load_rotation_cursors(catalog_name, user_ids, conn=None):
+    rows = await fetch_all(SQL_LOAD_CURSORS, catalog_name, user_ids, conn=conn)
+    return {row["user_id"]: RotationCursor(**row) for row in rows}
+
+async def save_rotation_cursors(catalog_name, cursors, conn=None):
+    if not cursors:
+        return
+    user_ids, sizes, signatures, starts, steps, positions = zip(*cursors)
+    await execute_query(
+        SQL_SAVE_CURSORS, catalog_name,
+        list(user_ids), list(sizes), list(signatures), list(starts), list(steps), list(positions),
+        conn=conn
+    )
 
-# === AFFIRMATIONS: 365 ЧЁТКИХ ФРАЗ С ЭМОДЗИ ===
-AFFIRMATIONS = [
-    "Я есть свет, и свет ведёт меня. ✨",
-    "Я доверяю пути, который раскрывается передо мной. 🌿",
-    "Во мне живёт тихая, сильная вера. 🤍",
-    "Я выбираю любовь в каждом решении. ❤️",
-    "Моя душа знает, куда идти. 🌱",
-    "Я в безопасности в этом мире. 🌾",
-    "Свет внутри меня ярче любых сомнений. ⚡️",
-    "Я разрешаю себе быть собой. 🤍",
-    "Жизнь поддерживает меня мягко и точно. 💚",
-    "Я дышу свободой и покоем. 🌙",
-    "Моё сердце открыто добру. 💛",
-    "Я принимаю себя полностью. 🤍",
-    "Вера наполняет мои шаги смыслом. 🌿",
-    "Я выбираю путь света. ✨",
-    "Я достоин любви просто потому, что существую. 💖",
-    "Мир отвечает мне теплом. 🌸",
-    "Я слышу голос своей души. 🌙",
-    "Всё приходит ко мне вовремя. 🍀",
-    "Я доверяю своему внутреннему знанию. 🤍",
-    "Любовь — мой ориентир. ❤️",
-    "Я живу в согласии с собой. 🌿",
-    "Свет направляет мои мысли. ✨",
-    "Я позволяю жизни быть щедрой ко мне. 💚",
-    "Я спокоен в настоящем моменте. 🌙",
-    "Моя вера глубока и тиха. 🤍",
-    "Я выбираю мягкость вместо борьбы. 🌸",
-    "Я под защитой высшего замысла. ☘️",
-    "Моё сердце знает правду. 💛",
-    "Я принимаю перемены с доверием. 🌱",
-    "Во мне достаточно сил. ⚡️",
-    "Я иду своим путём. 🌾",
-    "Свет раскрывается через меня. ✨",
-    "Я позволяю себе расти. 🌿",
-    "Моя жизнь наполнена смыслом. 🤍",
-    "Я доверяю процессу. 🌙",
-    "Любовь живёт во мне постоянно. 💖",
-    "Я спокоен и собран. 🌿",
-    "Мир благосклонен ко мне. 🌸",
-    "Я выбираю веру вместо страха. ✨",
-    "Моё дыхание — якорь покоя. 🌙",
-    "Я открыт новым чудесам. 🍀",
-    "Я чувствую поддержку жизни. 🌾",
-    "Всё, что мне нужно, уже во мне. 🤍",
-    "Я разрешаю себе светить. ⚡️",
-    "Я иду туда, где откликается сердце. ❤️",
-    "Моя душа в гармонии. 🌿",
-    "Я доверяю даже тогда, когда не всё ясно. 🌙",
-    "Любовь ведёт меня. 💚",
-    "Я выбираю быть в мире с собой. 🤍",
-    "Мой внутренний свет стабилен. ✨",
-    "Я принимаю свою уникальность. 🌸",
-    "Я живу из состояния веры. 🌿",
-    "Жизнь заботится обо мне. 💛",
-    "Я мягко отпускаю контроль. 🍀",
-    "Моё сердце спокойно. 🌙",
-    "Я слышу знаки жизни. 🌾",
-    "Я нахожусь в правильном месте. ☘️",
-    "Свет наполняет мои действия. ✨",
-    "Я позволяю добру входить в мою жизнь. 💖",
-    "Я верю себе. 🤍",
-    "Моя энергия чиста и ясна. ⚡️",
-    "Я выбираю путь любви. ❤️",
-    "Я в доверии к завтрашнему дню. 🌙",
-    "Всё складывается наилучшим образом. 🍀",
-    "Я принимаю жизнь такой, как она есть. 🌿",
-    "Мой свет нужен этому миру. ✨",
-    "Я спокоен внутри. 🌙",
-    "Я живу с открытым сердцем. 💚",
-    "Вера укрепляет меня. 🌱",
-    "Я позволяю себе быть настоящим. 🤍",
-    "Я несу свет через простые вещи. ✨",
-    "Моя жизнь — живой поток. 🌾",
-    "Я доверяю своему ритму. 🌿",
-    "Я выбираю ясность. 🌙",
-    "Любовь наполняет мои дни. 💛",
-    "Я устойчив в любых обстоятельствах. 🌱",
-    "Свет всегда возвращает меня к себе. ✨",
-    "Я в гармонии с миром. 🌿",
-    "Я отпускаю всё лишнее. 🍀",
-    "Моё сердце — мой дом. ❤️",
-    "Я чувствую опору внутри. 🌾",
-    "Жизнь говорит со мной мягко. 🌸",
-    "Я выбираю внутренний покой. 🌙",
-    "Я открыт поддержке. 🤍",
-    "Свет во мне неизменен. ✨",
-    "Я разрешаю себе доверять. 🌿",
-    "Я иду без спешки. 🌾",
-    "Моя вера спокойна и сильна. 🤍",
-    "Я принимаю каждый опыт. 🌱",
-    "Я живу в любви. 💖",
-    "Я слышу себя ясно. 🌙",
-    "Я позволяю жизни удивлять меня. 🌸",
-    "Мой путь благословлён. ☘️",
-    "Я выбираю свет даже в тишине. ✨",
-    "Я в ладу с собой. 🤍",
-    "Я чувствую целостность. 🌿",
-    "Любовь поддерживает меня. 💚",
-    "Я доверяю течению жизни. 🌾",
-    "Я нахожу покой внутри. 🌙",
-    "Я благодарен за этот день. 🌸",
-    "Каждый день я выбираю веру. ✨",
-    "Мой свет становится глубже. 🌱",
-    "Я живу из сердца. ❤️",
-    "Я позволяю себе замедляться. 🌿",
-    "Жизнь раскрывается передо мной. 🌾",
-    "Я принимаю себя здесь и сейчас. 🤍",
-    "Я в безопасности в своём выборе. ☘️",
-    "Моя вера тиха и устойчива. 🌙",
-    "Я отпускаю сопротивление. 🍀",
-    "Я доверяю даже в неопределённости. 🌿",
-    "Мой путь освещён. ✨",
-    "Я выбираю мягкую силу. 🌸",
-    "Я чувствую связь с жизнью. 🌱",
-    "Любовь ведёт мои слова. 💛",
-    "Я позволяю себе быть светлым. ✨",
-    "Я принимаю поддержку мира. 🤍",
-    "Я живу без спешки. 🌾",
-    "Вера наполняет мои шаги. 🌿",
-    "Я спокоен в своём центре. 🌙",
-    "Я доверяю времени. 🌙",
-    "Моя душа знает ответы. 🌙",
-    "Я выбираю ясность мыслей. ✨",
-    "Я открыт любви. ❤️",
-    "Свет внутри меня стабилен. ⚡️",
-    "Я принимаю свой путь полностью. 🌿",
-    "Я живу в согласии с истиной. 🤍",
-    "Жизнь добра ко мне. 🌸",
-    "Я чувствую благодарность. 🌾",
-    "Я позволяю себе быть живым. 🌱",
-    "Я доверяю каждому дню. 🌙",
-    "Моя вера поддерживает меня. 🌿",
-    "Я выбираю быть в мире. 🤍",
-    "Я чувствую свет в теле. ✨",
-    "Я принимаю свои чувства. ❤️",
-    "Я иду своим темпом. 🌾",
-    "Любовь раскрывает меня. 💚",
-    "Я в контакте с собой. 🌙",
-    "Я разрешаю жизни вести меня. 🌿",
-    "Мой свет спокоен. ✨",
-    "Я нахожусь в потоке. 🌾",
-    "Я доверяю своему сердцу. ❤️",
-    "Я выбираю присутствие. 🌙",
-    "Я принимаю сегодняшний день. 🌸",
-    "Свет направляет мои решения. ✨",
-    "Я живу из состояния веры. 🌿",
-    "Я открыт ясности. ✨",
-    "Я чувствую поддержку внутри. 🤍",
-    "Я позволяю себе быть мягким. 🌸",
-    "Я в гармонии с моментом. 🌙",
-    "Я благодарю жизнь. 🌾",
-    "Я принимаю глубину своего пути. 🌿",
-    "Моя вера растёт ежедневно. 🌱",
-    "Я живу с открытым взглядом. ✨",
-    "Я доверяю внутреннему свету. ⚡️",
-    "Я выбираю любовь снова и снова. ❤️",
-    "Я чувствую покой в теле. 🌙",
-    "Жизнь несёт меня бережно. 🌿",
-    "Я позволяю себе чувствовать. ❤️",
-    "Я в согласии с собой. 🤍",
-    "Я принимаю тишину. 🌙",
-    "Мой свет ясен. ✨",
-    "Я отпускаю напряжение. 🍀",
-    "Я выбираю доверие. 🌿",
-    "Я живу в настоящем. 🌙",
-    "Любовь наполняет пространство вокруг меня. 💚",
-    "Я спокоен в своих решениях. 🤍",
-    "Я слышу мудрость души. 🌙",
-    "Я разрешаю себе быть. 🌿",
-    "Я принимаю жизнь полностью. 🌾",
-    "Я выбираю внутренний свет. ✨",
-    "Я чувствую устойчивость. 🌱",
-    "Я доверяю каждому шагу. 🌿",
-    "Моя вера — моя опора. 🤍",
-    "Я живу без борьбы. 🌙",
-    "Я открыт добру. 💛",
-    "Я чувствую связь с миром. 🌾",
-    "Я принимаю себя с любовью. ❤️",
-    "Я позволяю жизни быть простой. 🌿",
-    "Я в мире с прошлым. 🌙",
-    "Я выбираю ясность сердца. ✨",
-    "Я благодарен за путь. 🌾",
-    "Я живу в доверии. 🌿",
-    "Свет наполняет мои дни. ⚡️",
-    "Я принимаю настоящее. 🌙",
-    "Я слышу себя. 🤍",
-    "Я выбираю мягкость. 🌸",
-    "Я в согласии с ритмом жизни. 🌾",
-    "Я позволяю себе замедлиться. 🌙",
-    "Я живу из любви. ❤️",
-    "Я доверяю даже тишине. 🌙",
-    "Мой путь светел. ✨",
-    "Я принимаю поддержку. 🤍",
-    "Я чувствую покой. 🌿",
-    "Я открыт новому дню. 🌸",
-    "Я выбираю веру в себя. ✨",
-    "Я живу с ясным намерением. 🌙",
-    "Любовь наполняет мои мысли. 💚",
-    "Я доверяю жизни. 🌿",
-    "Я в гармонии с собой. 🤍",
-    "Я благодарю этот момент. 🌸",
-    "Я принимаю свет в каждом дне. ✨",
-    "Моя вера спокойна. 🌙",
-    "Я живу в согласии с душой. 🌿",
-    "Я выбираю присутствие. 🌙",
-    "Я чувствую устойчивость внутри. 🌱",
-    "Я доверяю потоку. 🌾",
-    "Я открыт любви мира. 💖",
-    "Я принимаю свой путь. 🌿",
-    "Я живу без лишнего шума. 🌙",
-    "Я выбираю тишину сердца. 🤍",
-    "Свет ведёт меня мягко. ✨",
-    "Я благодарен за опыт. 🌾",
-    "Я принимаю ясность. ✨",
-    "Я доверяю своему выбору. 🌿",
-    "Я живу в любви к себе. ❤️",
-    "Я спокоен и собран. 🌙",
-    "Я разрешаю себе быть настоящим. 🌿",
-    "Я принимаю сегодняшний день. 🌸",
-    "Я чувствую внутренний свет. ⚡️",
-    "Я выбираю веру. ✨",
-    "Я доверяю своему пути. 🌾",
-    "Я в гармонии с миром. 🌿",
-    "Я принимаю каждый шаг. 🤍",
-    "Я живу из сердца. ❤️",
-    "Я благодарен жизни. 🌾",
-    "Я позволяю себе покой. 🌙",
-    "Я открыт свету. ✨",
-    "Я доверяю тишине. 🌙",
-    "Я принимаю глубину. 🌿",
-    "Я выбираю любовь. ❤️",
-    "Я живу в согласии. 🤍",
-    "Я чувствую поддержку. 🌾",
-    "Я доверяю настоящему. 🌙",
-    "Я принимаю себя. 🌿",
-    "Я выбираю ясность. ✨",
-    "Я спокоен внутри. 🌙",
-    "Я живу в потоке. 🌾",
-    "Я благодарен за свет. ✨",
-    "Я доверяю жизни полностью. 🌿",
-    "Я в мире с собой. 🤍",
-    "Я принимаю каждый новый день. 🌸",
-    "Моя вера устойчива. 🌱",
-    "Я живу с открытым сердцем. ❤️",
-    "Я выбираю внутренний свет. ✨",
-    "Я доверяю своему дыханию. 🌙",
-    "Я принимаю тишину как силу. 🌿",
-    "Я спокоен в своём центре. 🤍",
-    "Я благодарен за путь души. 🌾",
-    "Я живу в доверии к миру. 🌿",
-    "Я выбираю любовь без условий. 💖",
-    "Я чувствую ясность. ✨",
-    "Я принимаю жизнь. 🌙",
-    "Я живу в гармонии. 🌿",
-    "Я доверяю каждому моменту. 🤍",
-    "Я открыт мягкости. 🌸",
-    "Я выбираю веру в добро. ✨",
-    "Я чувствую поддержку света. ⚡️",
-    "Я принимаю свой ритм. 🌾",
-    "Я живу без спешки. 🌙",
-    "Я благодарен за настоящее. 🌸",
-    "Я доверяю своему сердцу. ❤️",
-    "Я выбираю покой. 🌙",
-    "Я принимаю глубину чувств. 🌿",
-    "Я живу из любви. 💚",
-    "Я спокоен в выборе. 🤍",
-    "Я доверяю жизни сегодня. 🌾",
-    "Я открыт истине. ✨",
-    "Я принимаю ясность пути. 🌙",
-    "Я живу в свете. ⚡️",
-    "Я благодарен за тишину. 🌙",
-    "Я выбираю внутреннюю опору. 🌿",
-    "Я доверяю своему знанию. 🤍",
-    "Я принимаю каждый опыт. 🌱",
-    "Я живу с верой. ✨",
-    "Я спокоен и целостен. 🌙",
-    "Я открыт любви. ❤️",
-    "Я доверяю процессу жизни. 🌾",
-    "Я принимаю себя полностью. 🤍",
-    "Я живу в согласии с душой. 🌿",
-    "Я благодарен за этот путь. 🌾",
-    "Я выбираю свет каждый день. ✨",
-    "Моя вера спокойна и ясна. 🌙",
-    "Я живу в присутствии. 🤍",
-    "Я доверяю настоящему моменту. 🌿",
-    "Я принимаю жизнь с любовью. ❤️",
-    "Я чувствую устойчивость света. ⚡️",
-    "Я выбираю доверие. 🌾",
-    "Я живу без сопротивления. 🌙",
-    "Я благодарен за каждый вдох. 🌿",
-    "Я принимаю свою глубину. 🌙",
-    "Я доверяю жизни полностью. 🌿",
-    "Я открыт внутренней тишине. 🌙",
-    "Я живу в гармонии с миром. 🌾",
-    "Я выбираю ясность сердца. ✨",
-    "Я принимаю сегодняшний день. 🌸",
-    "Я спокоен в себе. 🤍",
-    "Я доверяю пути души. 🌿",
-    "Я живу из любви и веры. ❤️",
-    "Я благодарен за свет внутри. ✨",
-    "Я принимаю этот момент. 🌙",
-    "Я выбираю присутствие и покой. 🌿",
-    "Моя вера — мой ориентир. ✨",
-    "Я живу с открытым сердцем. 💚",
-    "Я доверяю внутреннему свету. ⚡️",
-    "Я принимаю жизнь целиком. 🌾",
-    "Я спокоен и ясен. 🌙",
-    "Я выбираю мягкую силу. 🌸",
-    "Я живу в доверии к миру. 🌿",
-    "Я благодарен за каждый шаг. 🌾",
-    "Я принимаю себя здесь. 🤍",
-    "Я доверяю своему ритму. 🌾",
-    "Я живу в свете любви. 💖",
-    "Я выбираю веру каждый день. ✨",
-    "Я спокоен в тишине. 🌙",
-    "Я принимаю глубину пути. 🌿",
-    "Я доверяю жизни без условий. 🌾",
-    "Я живу в согласии с собой. 🤍",
-    "Я благодарен за настоящее. 🌸",
-    "Я выбираю ясность и покой. ✨",
-    "Я принимаю внутренний свет. ⚡️",
-    "Я доверяю каждому дню. 🌙",
-    "Моя вера устойчива. 🌱",
-    "Я живу с любовью. ❤️",
-    "Я выбираю присутствие. 🌙",
-    "Я принимаю путь души. 🌿",
-    "Я спокоен внутри. 🤍",
-    "Я доверяю жизни сейчас. 🌾",
-    "Я живу в гармонии. 🌿",
-    "Я благодарен за свет. ✨",
-    "Я принимаю этот день. 🌸",
-    "Я выбираю веру в добро. ✨",
-    "Я живу из сердца. ❤️",
-    "Я доверяю тишине. 🌙",
-    "Я спокоен в выборе. 🤍",
-    "Я принимаю себя полностью. 🌿",
-    "Я живу в свете. ⚡️",
-    "Я благодарен за путь. 🌾",
-    "Я выбираю любовь. ❤️",
-    "Я доверяю своему сердцу. 💚",
-    "Я принимаю жизнь. 🌙",
-    "Я живу в покое. 🌿",
-    "Я выбираю ясность. ✨",
-    "Я доверяю процессу. 🌾",
-    "Я благодарен за каждый момент. 🌸",
-    "Я принимаю настоящий миг. 🌙",
-    "Я живу с верой. 🌿",
-    "Я спокоен и целостен. 🤍",
-    "Я выбираю свет. ✨",
-    "Я доверяю жизни. 🌾",
-    "Я принимаю себя. 🌿",
-    "Я живу в любви и тишине. ❤️",
-    "Моя вера ведёт меня. ✨",
-    "Я выбираю присутствие в каждом дне. 🌙",
-    "Я доверяю своему пути. 🌾",
-    "Я принимаю глубину жизни. 🌿",
-    "Я спокоен внутри себя. 🤍",
-    "Я живу в гармонии со светом. ⚡️",
-    "Я благодарен за этот опыт. 🌸",
-    "Я выбираю любовь снова. ❤️",
-    "Я доверяю настоящему. 🌙",
-    "Я принимаю свет в себе. ✨",
-    "Я живу из веры. 🌿",
-    "Я спокоен в тишине сердца. 🤍",
-    "Я благодарен жизни. 🌾",
-    "Я есть свет, и этого достаточно. ✨"
-]
+# Аффирмации и вопросы уходят каждому в его местное время, небольшими корзинами
+# раз в DELIVERY_WINDOW_MINUTES, а не всей базе в одну секунду
+DEFAULT_TIMEZONE = os.getenv("TIMEZONE", "Europe/Moscow")
+DELIVERY_WINDOW_MINUTES = int(os.getenv("DELIVERY_WINDOW_MINUTES", "5"))
+AFFIRMATION_LOCAL_TIME = datetime.strptime(os.getenv("AFFIRMATION_TIME", "08:00"), "%H:%M").time()
+QUESTION_LOCAL_TIME = datetime.strptime(os.getenv("EVENING_QUESTION_TIME", "20:00"), "%H:%M").time()
+
+SCHEDULED_CONTENT = {
+    "affirmations": ("next_affirmation_at", AFFIRMATION_LOCAL_TIME),
+    "evening_questions": ("next_question_at", QUESTION_LOCAL_TIME),
+}
+
+# Все аудитории рассылок фильтруются условием REACHABLE_USERS —
+# оно совпадает с предикатом частичных индексов (см. DB_INDEXES)
+SQL_DUE_USERS = f"""
+    SELECT user_id FROM users
+    WHERE {{due_column}} <= $1 AND {REACHABLE_USERS}
+"""
+
+SQL_ADVANCE_DUE = """
+    UPDATE users
+    SET {due_column} = next_local_time(COALESCE(timezone, $3), $2, $4)
+    WHERE user_id = ANY($1::bigint[])
+"""
+
+SQL_ADVANCE_DUE_BY_CATALOG = {
+    catalog_name: named_sql(f"advance_{catalog_name}", SQL_ADVANCE_DUE.format(due_column=due_column))
+    for catalog_name, (due_column, _) in SCHEDULED_CONTENT.items()
+}
+
+async def _broadcast_content(catalog_name, template, log_label):
+    due_column, local_time = SCHEDULED_CONTENT[catalog_name]
+    now = datetime.utcnow()
 
-# === EVENING QUESTIONS: 365 ВОПРОСОВ ===
-EVENING_QUESTIONS = [
-    "Что сегодня принесло тебе покой?",
-    "В какой момент дня ты почувствовал(а) себя живым(ой)?",
-    "За что ты можешь поблагодарить этот день?",
-    "Где сегодня было больше всего тишины внутри?",
-    "Что получилось лучше, чем ты ожидал(а)?",
-    "Какое чувство сопровождало тебя чаще всего?",
-    "В чём ты сегодня был(а) честен(на) с собой?",
-    "Какой маленький знак поддержки ты заметил(а)?",
-    "Что сегодня стоило твоего внимания?",
-    "Где ты выбрал(а) мягкость вместо напряжения?",
-    "Какое решение сегодня приблизило тебя к себе?",
-    "Что ты отпускаешь, ложась спать?",
-    "Какой момент хочется сохранить в памяти?",
-    "В чём проявилась твоя сила сегодня?",
-    "Что сегодня было по-настоящему простым?",
-    "Где ты позволил(а) себе быть настоящим(ей)?",
-    "Что сегодня согрело твоё сердце?",
-    "Какой урок день прошептал тебе?",
-    "Где ты почувствовал(а) поддержку мира?",
-    "Что сегодня было достаточно?",
-    "В какой момент ты улыбнулся(ась) без причины?",
-    "Что сегодня помогло тебе замедлиться?",
-    "Где ты выбрал(а) доверие?",
-    "Что сегодня напомнило тебе о любви?",
-    "Какой шаг ты сделал(а) из заботы о себе?",
-    "Что сегодня было светлым даже в мелочах?",
-    "Где ты отпустил(а) контроль?",
-    "Какой звук, запах или образ запомнился?",
-    "Что сегодня дало ощущение дома?",
-    "Где ты был(а) в потоке?",
-    "Что сегодня поддержало твою веру?",
-    "В чём ты был(а) терпелив(а) к себе?",
-    "Что сегодня стало точкой опоры?",
-    "Где ты позволил(а) себе отдых?",
-    "Какое чувство ты принимаешь сейчас?",
-    "Что сегодня было искренним?",
-    "Где ты заметил(а) красоту?",
-    "Что сегодня показало тебе твои ценности?",
-    "Какой момент был самым тихим?",
-    "Что сегодня наполнило тебя благодарностью?",
-    "Где ты выбрал(а) себя?",
-    "Что сегодня было важнее, чем казалось утром?",
-    "Какой страх стал тише?",
-    "Что сегодня было про заботу?",
-    "Где ты разрешил(а) себе быть несовершенным(ой)?",
-    "Что сегодня принесло ощущение смысла?",
-    "Какой момент ты прожил(а) осознанно?",
-    "Что сегодня стало подарком?",
-    "Где ты почувствовал(а) связь с телом?",
-    "Что сегодня было про доверие жизни?",
-    "Какой выбор сегодня поддержал твою энергию?",
-    "Что сегодня напомнило тебе о твоей ценности?",
-    "Где ты был(а) внимателен(на) к чувствам?",
-    "Что сегодня стало поводом замедлиться?",
-    "Какой момент был самым тёплым?",
-    "Что сегодня ты принимаешь без сопротивления?",
-    "Где ты заметил(а) внутренний рост?",
-    "Что сегодня помогло тебе дышать свободнее?",
-    "Какой жест доброты ты сделал(а)?",
-    "Что сегодня было про ясность?",
-    "Где ты позволил(а) себе радость?",
-    "Что сегодня было честным признанием?",
-    "Какой момент ты прожил(а) сердцем?",
-    "Что сегодня стало шагом к балансу?",
-    "Где ты выбрал(а) покой?",
-    "Что сегодня было неожиданно хорошим?",
-    "Какой разговор оставил след?",
-    "Что сегодня ты отпускаешь с благодарностью?",
-    "Где ты заметил(а) синхронии?",
-    "Что сегодня напомнило тебе о свете?",
-    "Какой момент был про принятие?",
-    "Что сегодня укрепило твою веру в себя?",
-    "Где ты был(а) мягок(ка) к миру?",
-    "Что сегодня стало внутренним «да»?",
-    "Какой страх ты сегодня не подпитал(а)?",
-    "Что сегодня было про присутствие?",
-    "Где ты позволил(а) себе паузу?",
-    "Что сегодня принесло ощущение завершённости?",
-    "Какой момент был про благодарность телу?",
-    "Что сегодня было достаточно просто так?",
-    "Где ты сегодня выбрал(а) любовь?",
-    "Что сегодня помогло тебе быть здесь-и-сейчас?",
-    "Какой момент показал твою смелость?",
-    "Что сегодня стало тихой радостью?",
-    "Где ты почувствовал(а) устойчивость?",
-    "Что сегодня было про заботу о будущем?",
-    "Какой выбор был про уважение к себе?",
-    "Что сегодня напомнило тебе о твоей силе?",
-    "Где ты позволил(а) себе расслабиться?",
-    "Что сегодня было про доверие процессу?",
-    "Какой момент стал якорем?",
-    "Что сегодня было про ясность намерений?",
-    "Где ты был(а) особенно внимателен(на)?",
-    "Что сегодня стало маленькой победой?",
-    "Какой шаг был сделан из любви?",
-    "Что сегодня было про гармонию?",
-    "Где ты заметил(а) благодарность других?",
-    "Что сегодня принесло ощущение целостности?",
-    "Какой момент ты хочешь повторить?",
-    "Что сегодня было самым ценным?",
-    "Где ты сегодня выбрал(а) мягкость к себе?",
-    "Что сегодня показало твою зрелость?",
-    "Какой момент был про доверие сердцу?",
-    "Что сегодня стало источником спокойствия?",
-    "Где ты позволил(а) себе быть медленнее?",
-    "Что сегодня было про внутренний порядок?",
-    "Какой выбор поддержал твою ясность?",
-    "Что сегодня напомнило тебе о доме внутри?",
-    "Где ты почувствовал(а) опору?",
-    "Что сегодня было про принятие реальности?",
-    "Какой момент был про благодарность миру?",
-    "Что сегодня стало точкой роста?",
-    "Где ты был(а) честен(на) с чувствами?",
-    "Что сегодня принесло ощущение лёгкости?",
-    "Какой шаг был сделан без спешки?",
-    "Что сегодня было про тишину?",
-    "Где ты заметил(а) заботу жизни о тебе?",
-    "Что сегодня стало знаком правильного пути?",
-    "Какой момент был про доверие телу?",
-    "Что сегодня было достаточно без усилий?",
-    "Где ты сегодня выбрал(а) присутствие?",
-    "Что сегодня помогло тебе быть устойчивым(ой)?",
-    "Какой момент был про искренность?",
-    "Что сегодня стало тихим согласием с собой?",
-    "Где ты позволил(а) себе отдых без вины?",
-    "Что сегодня было про уважение границ?",
-    "Какой шаг поддержал твою энергию?",
-    "Что сегодня напомнило тебе о красоте жизни?",
-    "Где ты почувствовал(а) благодарность?",
-    "Что сегодня было про внутренний свет?",
-    "Какой момент стал напоминанием о любви?",
-    "Что сегодня укрепило твоё доверие миру?",
-    "Где ты был(а) особенно бережен(на)?",
-    "Что сегодня было про ясный выбор?",
-    "Какой шаг был сделан с открытым сердцем?",
-    "Что сегодня стало моментом покоя?",
-    "Где ты отпустил(а) ожидания?",
-    "Что сегодня принесло ощущение смысла?",
-    "Какой момент был про принятие себя?",
-    "Что сегодня было достаточно для счастья?",
-    "Где ты сегодня выбрал(а) спокойствие?",
-    "Что сегодня помогло тебе довериться?",
-    "Какой момент был про внутреннюю тишину?",
-    "Что сегодня стало проявлением заботы?",
-    "Где ты позволил(а) себе быть собой?",
-    "Что сегодня было про гармонию с телом?",
-    "Какой шаг был сделан из ясности?",
-    "Что сегодня напомнило тебе о ценности времени?",
-    "Где ты почувствовал(а) баланс?",
-    "Что сегодня было про мягкую силу?",
-    "Где ты сегодня заметил(а) радость?",
-    "Что сегодня помогло тебе замедлиться?",
-    "Какой момент был про доверие интуиции?",
-    "Что сегодня стало источником тепла?",
-    "Где ты был(а) в согласии с собой?",
-    "Что сегодня было про ясный фокус?",
-    "Какой шаг поддержал твоё спокойствие?",
-    "Что сегодня напомнило тебе о благодарности?",
-    "Где ты почувствовал(а) устойчивость?",
-    "Что сегодня было про внутренний покой?",
-    "Где ты сегодня выбрал(а) простоту?",
-    "Что сегодня помогло тебе быть внимательным(ой)?",
-    "Какой момент был про принятие пути?",
-    "Что сегодня стало тихой радостью?",
-    "Где ты позволил(а) себе доверие?",
-    "Что сегодня было про заботу о себе?",
-    "Какой шаг был сделан из любви к жизни?",
-    "Что сегодня напомнило тебе о ценности настоящего?",
-    "Где ты почувствовал(а) тепло?",
-    "Что сегодня было достаточно без лишнего?",
-    "Где ты сегодня выбрал(а) ясность?",
-    "Что сегодня помогло тебе отпустить?",
-    "Какой момент был про внутренний рост?",
-    "Что сегодня стало опорой?",
-    "Где ты был(а) особенно искренен(на)?",
-    "Что сегодня было про доверие процессу?",
-    "Какой шаг поддержал твою гармонию?",
-    "Что сегодня напомнило тебе о свете?",
-    "Где ты почувствовал(а) благодарность телу?",
-    "Что сегодня было про мягкое принятие?",
-    "Где ты сегодня выбрал(а) спокойный ритм?",
-    "Что сегодня помогло тебе быть в моменте?",
-    "Какой момент был про любовь к себе?",
-    "Что сегодня стало знаком заботы?",
-    "Где ты позволил(а) себе тишину?",
-    "Что сегодня было про ясный взгляд?",
-    "Какой шаг был сделан без напряжения?",
-    "Что сегодня напомнило тебе о доверии?",
-    "Где ты почувствовал(а) баланс?",
-    "Что сегодня было про внутреннюю устойчивость?",
-    "Где ты сегодня выбрал(а) мягкость?",
-    "Что сегодня помогло тебе почувствовать опору?",
-    "Какой момент был про благодарность жизни?",
-    "Что сегодня стало источником спокойствия?",
-    "Где ты был(а) честен(на) с собой?",
-    "Что сегодня было про принятие чувств?",
-    "Какой шаг поддержал твою ясность?",
-    "Что сегодня напомнило тебе о доме внутри?",
-    "Где ты почувствовал(а) тепло сердца?",
-    "Что сегодня было достаточно для покоя?",
-    "Где ты сегодня выбрал(а) присутствие?",
-    "Что сегодня помогло тебе довериться пути?",
-    "Какой момент был про тишину внутри?",
-    "Что сегодня стало проявлением заботы о себе?",
-    "Где ты позволил(а) себе быть настоящим(ей)?",
-    "Что сегодня было про ясное намерение?",
-    "Какой шаг был сделан с лёгкостью?",
-    "Что сегодня напомнило тебе о благодарности?",
-    "Где ты почувствовал(а) устойчивость?",
-    "Что сегодня было про внутренний свет?",
-    "Где ты сегодня выбрал(а) гармонию?",
-    "Что сегодня помогло тебе замедлиться?",
-    "Какой момент был про доверие сердцу?",
-    "Что сегодня стало источником тепла?",
-    "Где ты был(а) в согласии с собой?",
-    "Что сегодня было про ясность выбора?",
-    "Какой шаг поддержал твою энергию?",
-    "Что сегодня напомнило тебе о ценности простоты?",
-    "Где ты почувствовал(а) благодарность?",
-    "Что сегодня было достаточно без усилий?",
-    "Где ты сегодня выбрал(а) спокойствие?",
-    "Что сегодня помогло тебе отпустить контроль?",
-    "Какой момент был про принятие пути?",
-    "Что сегодня стало тихой радостью?",
-    "Где ты позволил(а) себе отдых?",
-    "Что сегодня было про заботу о теле?",
-    "Какой шаг был сделан из ясности?",
-    "Что сегодня напомнило тебе о красоте момента?",
-    "Где ты почувствовал(а) тепло?",
-    "Что сегодня было про внутренний покой?",
-    "Где ты сегодня выбрал(а) мягкость к себе?",
-    "Что сегодня помогло тебе быть внимательным(ой)?",
-    "Какой момент был про благодарность миру?",
-    "Что сегодня стало точкой опоры?",
-    "Где ты был(а) особенно бережен(на)?",
-    "Что сегодня было про ясный фокус?",
-    "Какой шаг поддержал твою гармонию?",
-    "Что сегодня напомнило тебе о доверии?",
-    "Где ты почувствовал(а) устойчивость?",
-    "Что сегодня было достаточно для спокойствия?",
-    "Где ты сегодня выбрал(а) присутствие?",
-    "Что сегодня помогло тебе быть здесь-и-сейчас?",
-    "Какой момент был про любовь?",
-    "Что сегодня стало источником тишины?",
-    "Где ты позволил(а) себе быть собой?",
-    "Что сегодня было про принятие себя?",
-    "Какой шаг был сделан с открытым сердцем?",
-    "Что сегодня напомнило тебе о ценности жизни?",
-    "Где ты почувствовал(а) благодарность?",
-    "Что сегодня было достаточно просто так?",
-    "Где ты сегодня выбрал(а) ясность?",
-    "Что сегодня помогло тебе довериться?",
-    "Какой момент был про внутренний рост?",
-    "Что сегодня стало опорой?",
-    "Где ты был(а) честен(на) с чувствами?",
-    "Что сегодня было про мягкое принятие?",
-    "Какой шаг поддержал твоё спокойствие?",
-    "Что сегодня напомнило тебе о свете?",
-    "Где ты почувствовал(а) тепло сердца?",
-    "Что сегодня было достаточно для баланса?",
-    "Где ты сегодня выбрал(а) гармонию?",
-    "Что сегодня помогло тебе замедлиться?",
-    "Какой момент был про доверие процессу?",
-    "Что сегодня стало источником покоя?",
-    "Где ты был(а) в согласии с собой?",
-    "Что сегодня было про ясный выбор?",
-    "Какой шаг поддержал твою энергию?",
-    "Что сегодня напомнило тебе о благодарности?",
-    "Где ты почувствовал(а) устойчивость?",
-    "Что сегодня было достаточно без лишнего?",
-    "Где ты сегодня выбрал(а) спокойствие?",
-    "Что сегодня помогло тебе отпустить?",
-    "Какой момент был про принятие пути?",
-    "Что сегодня стало тихой радостью?"
-]
+    async def plan_chunk(user_ids):
+        # Каталог берём на каждую пачку: перезагрузка подхватывается на лету
+        catalog = content_catalogs[catalog_name]
+        cursors = await load_rotation_cursors(catalog_name, user_ids)
+        planned = []
+        for user_id in user_ids:
+            index, cursor = advance_rotation(cursors.get(user_id), user_id, catalog)
+            planned.append((OutgoingMessage(user_id, template.format(catalog.text_at(index))), cursor))
+        return planned
+
+    async def record_chunk(cursors, conn):
+        # Сообщение уже в outbox и будет доставлено с повторами — курсор и срок двигаем сразу
+        user_ids = [cursor.user_id for cursor in cursors]
+        await save_rotation_cursors(catalog_name, cursors, conn=conn)
+        await execute_query(
+            SQL_ADVANCE_DUE_BY_CATALOG[catalog_name], user_ids, local_time, DEFAULT_TIMEZONE, now, conn=conn
+        )
 
-async def get_unique_affirmation(user_id: int):
-    since = datetime.utcnow() - timedelta(days=365)
-    rows = await execute_query(
-        "SELECT affirmation_hash FROM sent_affirmations WHERE user_id = $1 AND sent_at > $2",
-        user_id, since
+    return await run_broadcast(
+        log_label, SQL_DUE_USERS.format(due_column=due_column), (now,),
+        plan_chunk, record_chunk, priority=OUTBOX_PRIORITY_HIGH
     )
-    used_hashes = {row["affirmation_hash"] for row in rows}
-    
-    for text in AFFIRMATIONS:
-        hash_ = hashlib.sha256(text.encode()).hexdigest()[:16]
-        if hash_ not in used_hashes:
-            await execute_query(
-                "INSERT INTO sent_affirmations (user_id, affirmation_hash, sent_at) VALUES ($1, $2, $3)",
-                user_id, hash_, datetime.utcnow()
-            )
-            return text
-    
-    text = random.choice(AFFIRMATIONS)
-    hash_ = hashlib.sha256(text.encode()).hexdigest()[:16]
-    await execute_query(
-        "INSERT INTO sent_affirmations (user_id, affirmation_hash, sent_at) VALUES ($1, $2, $3)",
-        user_id, hash_, datetime.utcnow()
-    )
-    return text
 
-async def get_unique_question(user_id: int):
-    since = datetime.utcnow() - timedelta(days=365)
-    rows = await execute_query(
-        "SELECT question_hash FROM sent_questions WHERE user_id = $1 AND sent_at > $2",
-        user_id, since
+# === МИГРАЦИИ СТАРОЙ ИСТОРИИ ===
+LEGACY_HISTORY_DAYS = 365
+# Старая история отправок (sent_*): больше не пишется и не создаётся. Миграция 0001 переносит её
+# в курсоры ротации, 0006 удаляет таблицы. На новой базе их нет вовсе
+LEGACY_HISTORY_TABLES = (
+    ("affirmations", "sent_affirmations", "affirmation_hash"),
+    ("evening_questions", "sent_questions", "question_hash"),
+)
+
+async def migrate_history_to_cursors(conn):
+    since = datetime.utcnow() - timedelta(days=LEGACY_HISTORY_DAYS)
+    for catalog_name, table, hash_column in LEGACY_HISTORY_TABLES:
+        if await conn.fetchval("SELECT to_regclass($1)", table) is None:
+            continue
+        catalog = content_catalogs[catalog_name]
+        rows = await conn.fetch(f"""
+            SELECT s.user_id, array_agg(DISTINCT s.{hash_column}) AS hashes
+            FROM {table} s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.sent_at > $1
+            GROUP BY s.user_id
+        """, since)
+        cursors = []
+        for row in rows:
+            seen = {
+                catalog.position_by_id[catalog.id_by_hash[hash_]]
+                for hash_ in row["hashes"] if hash_ in catalog.id_by_hash
+            }
+            # Старый код шёл по каталогу по порядку — продолжаем с первого непоказанного
+            position = next((index for index in range(len(catalog)) if index not in seen), None)
+            if position is None:
+                cursors.append(new_rotation(row["user_id"], catalog))
+            else:
+                cursors.append(RotationCursor(row["user_id"], len(catalog), catalog.signature, 0, 1, position))
+        await save_rotation_cursors(catalog_name, cursors, conn=conn)
+        print(f"🗃 Migrated {len(cursors)} {catalog_name} histories to rotation cursors")
+
+async def drop_legacy_history(conn):
+    # Курсоры уже построены миграцией 0001 — история больше ни для чего не нужна
+    for _, table, _ in LEGACY_HISTORY_TABLES:
+        await conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+async def backfill_cursor_signatures(conn):
+    # Курсоры, построенные до появления подписи, считаем построенными по текущему каталогу
+    for catalog_name, catalog in content_catalogs.items():
+        await conn.execute("""
+            UPDATE content_cursors SET cycle_signature = $2
+            WHERE catalog = $1 AND cycle_size = $3 AND cycle_signature IS NULL
+        """, catalog_name, catalog.signature, len(catalog))
+
+async def backfill_delivery_schedule(conn):
+    now = datetime.utcnow()
+    await conn.execute("UPDATE users SET timezone = $1 WHERE timezone IS NULL", DEFAULT_TIMEZONE)
+    for due_column, local_time in SCHEDULED_CONTENT.values():
+        await conn.execute(f"""
+            UPDATE users SET {due_column} = next_local_time(timezone, $1, $2)
+            WHERE {due_column} IS NULL
+        """, local_time, now)
+
+# Расхождение users.last_entry_at / entry_count с entries: пусто, если счётчики целы
+SQL_ACTIVITY_DRIFT = """
+    SELECT u.user_id,
+        u.last_entry_at, s.last_entry_at AS actual_last_entry_at,
+        u.entry_count, COALESCE(s.entry_count, 0) AS actual_entry_count
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, MAX(created_at) AS last_entry_at, COUNT(*) AS entry_count
+        FROM entries GROUP BY user_id
+    ) s ON s.user_id = u.user_id
+    WHERE u.last_entry_at IS DISTINCT FROM s.last_entry_at
+        OR u.entry_count <> COALESCE(s.entry_count, 0)
+"""
+
+SQL_REPAIR_ACTIVITY = f"""
+    UPDATE users u
+    SET last_entry_at = d.actual_last_entry_at, entry_count = d.actual_entry_count
+    FROM ({SQL_ACTIVITY_DRIFT}) d
+    WHERE u.user_id = d.user_id
+"""
+
+async def backfill_user_activity(conn):
+    await conn.execute(SQL_REPAIR_ACTIVITY)
+
+# Полный пересчёт user_stats из entries. Серии — «острова» подряд идущих местных дней:
+# day - row_number одинаков внутри одного острова
+SQL_REBUILD_USER_STATS = """
+    WITH days AS (
+        SELECT e.user_id, ((e.created_at AT TIME ZONE 'UTC') AT TIME ZONE COALESCE(u.timezone, $1))::date AS day,
+            COUNT(*) AS entries
+        FROM entries e
+        JOIN users u ON u.user_id = e.user_id
+        GROUP BY 1, 2
+    ), islands AS (
+        SELECT user_id, day, day - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day))::int AS island
+        FROM days
+    ), streaks AS (
+        SELECT DISTINCT ON (user_id) user_id, MAX(day) AS streak_day, COUNT(*) AS current_streak,
+            MAX(COUNT(*)) OVER (PARTITION BY user_id) AS longest_streak
+        FROM islands
+        GROUP BY user_id, island
+        ORDER BY user_id, MAX(day) DESC
+    ), weeks AS (
+        SELECT DISTINCT ON (user_id) user_id, date_trunc('week', day)::date AS week_start,
+            SUM(entries) OVER (PARTITION BY user_id, date_trunc('week', day)) AS week_entries
+        FROM days
+        ORDER BY user_id, day DESC
+    ), counts AS (
+        SELECT user_id,
+            COUNT(*) FILTER (WHERE entry_type = 'achievement') AS achievements,
+            COUNT(*) FILTER (WHERE entry_type = 'gratitude') AS gratitudes,
+            COUNT(*) FILTER (WHERE entry_type = 'free') AS free_entries,
+            COUNT(*) FILTER (WHERE entry_type = 'here_and_now') AS here_and_now_entries,
+            MIN(created_at) AS first_entry_at
+        FROM entries
+        GROUP BY user_id
     )
-    used_hashes = {row["question_hash"] for row in rows}
-    
-    for text in EVENING_QUESTIONS:
-        hash_ = hashlib.sha256(text.encode()).hexdigest()[:16]
-        if hash_ not in used_hashes:
-            await execute_query(
-                "INSERT INTO sent_questions (user_id, question_hash, sent_at) VALUES ($1, $2, $3)",
-                user_id, hash_, datetime.utcnow()
-            )
-            return text
-    
-    text = random.choice(EVENING_QUESTIONS)
-    hash_ = hashlib.sha256(text.encode()).hexdigest()[:16]
-    await execute_query(
-        "INSERT INTO sent_questions (user_id, question_hash, sent_at) VALUES ($1, $2, $3)",
-        user_id, hash_, datetime.utcnow()
+    INSERT INTO user_stats (
+        user_id, achievements, gratitudes, free_entries, here_and_now_entries,
+        first_entry_at, streak_day, current_streak, longest_streak, week_start, week_entries
     )
-    return text
+    SELECT c.user_id, c.achievements, c.gratitudes, c.free_entries, c.here_and_now_entries,
+        c.first_entry_at, s.streak_day, s.current_streak, s.longest_streak, w.week_start, w.week_entries
+    FROM counts c
+    JOIN streaks s ON s.user_id = c.user_id
+    JOIN weeks w ON w.user_id = c.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        achievements = EXCLUDED.achievements,
+        gratitudes = EXCLUDED.gratitudes,
+        free_entries = EXCLUDED.free_entries,
+        here_and_now_entries = EXCLUDED.here_and_now_entries,
+        first_entry_at = EXCLUDED.first_entry_at,
+        streak_day = EXCLUDED.streak_day,
+        current_streak = EXCLUDED.current_streak,
+        longest_streak = EXCLUDED.longest_streak,
+        week_start = EXCLUDED.week_start,
+        week_entries = EXCLUDED.week_entries
+"""
+
+async def rebuild_user_stats(conn):
+    # SHARE-блокировка не даёт новым записям проскочить между пересчётом и заменой счётчиков
+    await conn.execute("LOCK TABLE entries IN SHARE MODE")
+    await conn.execute("""
+        DELETE FROM user_stats s
+        WHERE NOT EXISTS (SELECT 1 FROM entries e WHERE e.user_id = s.user_id)
+    """)
+    await conn.execute(SQL_REBUILD_USER_STATS, DEFAULT_TIMEZONE)
+
+MIGRATIONS = [
+    ("0001_content_cursors_from_history", migrate_history_to_cursors),
+    ("0003_users_delivery_schedule", backfill_delivery_schedule),
+    ("0004_users_last_entry", backfill_user_activity),
+    ("0005_user_stats", rebuild_user_stats),
+    ("0006_drop_legacy_history", drop_legacy_history),
+    ("0007_content_cursor_signatures", backfill_cursor_signatures),
+]
 
 # === FSM STATES ===
 class JournalStates(StatesGroup):
@@ -806,8 +1076,288 @@ class JournalStates(StatesGroup):
     waiting_for_name = State()
     waiting_for_response = State()
 
+# === LRU-КЭШ ===
+class LRUCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, stored_at = item
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._items[key]
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # Возвращает вытесненные пары (key, value), чтобы владелец мог их дописать
+        self._items[key] = (value, time.monotonic())
+        self._items.move_to_end(key)
+        evicted = []
+        while len(self._items) > self.maxsize:
+            evicted_key, (evicted_value, _) = self._items.popitem(last=False)
+            evicted.append((evicted_key, evicted_value))
+            self.evictions += 1
+        return evicted
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def items(self):
+        return [(key, value) for key, (value, _) in self._items.items()]
+
+# === ПРОФИЛИ ПОЛЬЗОВАТЕЛЕЙ ===
+# Имя и флаг инструкции читаются почти в каждом ответе — держим их в процессе.
+# Все записи этих полей обязаны вызывать invalidate_user_profile; TTL страхует
+# от записей из других реплик.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "600"))
+
+UserProfile = namedtuple("UserProfile", "soft_name seen_instructions")
+
+profile_cache = LRUCache(PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+SQL_USER_PROFILE = named_sql(
+    "user_profile", "SELECT soft_name, seen_instructions FROM users WHERE user_id = $1"
+)
+
+async def get_user_profile(user_id):
+    # None — пользователя ещё нет; такие ответы не кэшируем, он вот-вот нажмёт /start
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        row = await fetch_one(SQL_USER_PROFILE, user_id)
+        if row is None:
+            return None
+        profile = UserProfile(row["soft_name"], bool(row["seen_instructions"]))
+        profile_cache.set(user_id, profile)
+    return profile
+
+def invalidate_user_profile(user_id):
+    profile_cache.pop(user_id)
+
+def get_profile_cache_stats():
+    lookups = profile_cache.hits + profile_cache.misses
+    return {
+        "size": len(profile_cache),
+        "max_size": PROFILE_CACHE_SIZE,
+        "hits": profile_cache.hits,
+        "misses": profile_cache.misses,
+        "hit_rate": round(profile_cache.hits / lookups, 3) if lookups else 0.0,
+        "evictions": profile_cache.evictions,
+    }
+
+# === FSM STORAGE В POSTGRES ===
+# Состояния переживают редеплой. По умолчанию (одна реплика) запись отложенная: переходы
+# меняют только LRU-кэш, а фоновая задача раз в FSM_FLUSH_INTERVAL сбрасывает изменения
+# одним запросом. Кэш локален для процесса и ничем не инвалидируется, поэтому при нескольких
+# репликах (webhook за балансировщиком, перекрытие при деплое) задайте FSM_CACHE_TTL:
+# тогда запись сквозная (обработчик ждёт коммита), а прочитанное живёт в кэше не дольше
+# FSM_CACHE_TTL секунд; FSM_CACHE_TTL=0 — всегда читать из базы.
+# В любом режиме строка в базе не перезаписывается более старым updated_at.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = float(os.environ["FSM_CACHE_TTL"]) if os.getenv("FSM_CACHE_TTL") else None
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+
+SQL_FSM_LOAD = named_sql("fsm_load", "SELECT state, data, updated_at FROM fsm_states WHERE key = $1")
+
+SQL_FSM_UPSERT = named_sql("fsm_upsert", """
+    INSERT INTO fsm_states (key, state, data, updated_at)
+    SELECT * FROM unnest($1::text[], $2::text[], $3::jsonb[], $4::timestamp[])
+    ON CONFLICT (key) DO UPDATE SET
+        state = EXCLUDED.state,
+        data = EXCLUDED.data,
+        updated_at = EXCLUDED.updated_at
+    WHERE fsm_states.updated_at <= EXCLUDED.updated_at
+""")
+
+SQL_FSM_DELETE = """
+    DELETE FROM fsm_states f
+    USING unnest($1::text[], $2::timestamp[]) AS d(key, updated_at)
+    WHERE f.key = d.key AND f.updated_at <= d.updated_at
+"""
+
+class FsmRecord:
+    __slots__ = ("state", "data", "updated_at", "version", "flushed_version")
+
+    def __init__(self, state=None, data=None, updated_at=None, dirty=False):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+        self.version = 1 if dirty else 0
+        self.flushed_version = 0
+
+    @property
+    def dirty(self):
+        return self.version != self.flushed_version
+
+    @property
+    def empty(self):
+        return self.state is None and not self.data
+
+    def expired(self):
+        return (
+            self.updated_at is not None
+            and datetime.utcnow() - self.updated_at > timedelta(seconds=FSM_STATE_TTL)
+        )
+
+class PostgresStorage(BaseStorage):
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # С TTL запись сквозная, и к моменту истечения грязных записей в кэше уже нет
+        self.write_through = FSM_CACHE_TTL is not None
+        self._cache = LRUCache(FSM_CACHE_SIZE, ttl=FSM_CACHE_TTL)
+        self._pending = {}  # вытеснены из кэша, но ещё не записаны в базу
+        self._flusher = None
+        self._last_sweep = time.monotonic()
+
+    def _remember(self, key, record):
+        # Запись возвращается в кэш — из _pending её убираем, иначе ключ попадёт во flush дважды
+        self._pending.pop(key, None)
+        for evicted_key, evicted in self._cache.set(key, record):
+            if evicted.dirty:
+                self._pending[evicted_key] = evicted
+
+    async def _record(self, key: StorageKey):
+        db_key = self.key_builder.build(key)
+        record = self._cache.get(db_key)
+        if record is None and db_key in self._pending:
+            record = self._pending[db_key]
+            self._remember(db_key, record)
+        if record is None:
+            row = await fetch_one(SQL_FSM_LOAD, db_key)
+            # Пока шёл запрос, запись могла появиться в кэше — она свежее
+            record = self._cache.get(db_key) or self._pending.get(db_key)
+            if record is None:
+                if row:
+                    record = FsmRecord(row["state"], json.loads(row["data"]), row["updated_at"])
+                else:
+                    record = FsmRecord()
+            self._remember(db_key, record)
+        if record.expired():
+            record.state, record.data = None, {}
+            self._touch(db_key, record)
+        return db_key, record
+
+    def _touch(self, db_key, record):
+        record.updated_at = datetime.utcnow()
+        record.version += 1
+        self._remember(db_key, record)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _write_through(self, db_key, record):
+        if self.write_through:
+            await self._write([(db_key, record, record.version)])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(db_key, record)
+        await self._write_through(db_key, record)
+
+    async def get_state(self, key: StorageKey):
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data):
+        db_key, record = await self._record(key)
+        record.data = copy.deepcopy(data)
+        self._touch(db_key, record)
+        await self._write_through(db_key, record)
+
+    async def get_data(self, key: StorageKey):
+        _, record = await self._record(key)
+        return copy.deepcopy(record.data)
+
+    async def flush(self):
+        # По ключу — не больше одной строки: ON CONFLICT DO UPDATE не обновит строку дважды.
+        # Кэш идёт вторым и побеждает: там запись свежее
+        latest = dict([*self._pending.items(), *self._cache.items()])
+        dirty = [(key, record, record.version) for key, record in latest.items() if record.dirty]
+        if not dirty:
+            return 0
+        await self._write(dirty)
+        return len(dirty)
+
+    async def _write(self, dirty):
+        upserts = [(key, record) for key, record, _ in dirty if not record.empty]
+        deletes = [(key, record) for key, record, _ in dirty if record.empty]
+        async with db_transaction() as conn:
+            if upserts:
+                await execute_query(
+                    SQL_FSM_UPSERT,
+                    [key for key, _ in upserts],
+                    [record.state for _, record in upserts],
+                    [json.dumps(record.data) for _, record in upserts],
+                    [record.updated_at for _, record in upserts],
+                    conn=conn
+                )
+            if deletes:
+                await execute_query(
+                    SQL_FSM_DELETE,
+                    [key for key, _ in deletes], [record.updated_at for _, record in deletes],
+                    conn=conn
+                )
+        for key, record, version in dirty:
+            record.flushed_version = max(record.flushed_version, version)
+            if not record.dirty and self._pending.get(key) is record:
+                del self._pending[key]
+
+    async def sweep(self):
+        # Брошенные на полпути состояния (человек ушёл из диалога) живут не дольше FSM_STATE_TTL
+        cutoff = datetime.utcnow() - timedelta(seconds=FSM_STATE_TTL)
+        status = await execute_query("DELETE FROM fsm_states WHERE updated_at < $1", cutoff)
+        for key, record in self._cache.items():
+            if not record.dirty and record.expired():
+                self._cache.pop(key)
+        self._last_sweep = time.monotonic()
+        return affected_rows(status)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_sweep > FSM_SWEEP_INTERVAL:
+                    expired = await self.sweep()
+                    if expired:
+                        print(f"🧹 Expired {expired} abandoned FSM states")
+            except Exception as exc:
+                print(f"FSM flush error: {exc}")
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+def create_fsm_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return PostgresStorage()
+
 # === ROUTER ===
 router = Router()
+router.message.middleware(metrics_middleware)
+router.callback_query.middleware(metrics_middleware)
 
 def get_addressing(soft_name):
     return f"{soft_name}, " if soft_name else ""
@@ -832,14 +1382,31 @@ async def get_user_menu(user_id: int) -> ReplyKeyboardMarkup:
     return get_main_menu()
 
 # === START ===
+# Вернувшемуся после блокировки сроки доставки считаем от сейчас, как при снятии тишины:
+# старые давно прошли, и аффирмация с вопросом пришли бы разом, невпопад
+SQL_UPSERT_USER = named_sql("upsert_user", """
+    INSERT INTO users (user_id, username, timezone, next_affirmation_at, next_question_at)
+    VALUES ($1, $2, $3, next_local_time($3, $4, $6), next_local_time($3, $5, $6))
+    ON CONFLICT (user_id) DO UPDATE
+    SET username = $2, delivery_status = 'active',
+        next_affirmation_at = CASE WHEN users.delivery_status = 'active' THEN users.next_affirmation_at
+            ELSE next_local_time(COALESCE(users.timezone, $3), $4, $6) END,
+        next_question_at = CASE WHEN users.delivery_status = 'active' THEN users.next_question_at
+            ELSE next_local_time(COALESCE(users.timezone, $3), $5, $6) END
+""")
+
+# Имя и флаг инструкции — одним запросом; old хранит значение флага до обновления
+SQL_SET_SOFT_NAME = named_sql("set_soft_name", """
+    UPDATE users u SET soft_name = $1, seen_instructions = TRUE
+    FROM users old
+    WHERE u.user_id = $2 AND old.user_id = u.user_id
+    RETURNING old.seen_instructions
+""")
+
 @router.message(F.text == "/start")
 async def cmd_start(message: Message, state: FSMContext):
-    await execute_query("""
-        INSERT INTO users (user_id, username)
-        VALUES ($1, $2)
-        ON CONFLICT (user_id) DO UPDATE 
-        SET username = $2
-    """, message.from_user.id, message.from_user.username)
+    await execute_query(SQL_UPSERT_USER, message.from_user.id, message.from_user.username, DEFAULT_TIMEZONE,
+        AFFIRMATION_LOCAL_TIME, QUESTION_LOCAL_TIME, datetime.utcnow())
     
     await message.answer(
         "Привет. Это твой дневник — место, где можно быть собой.\n\n"
@@ -863,20 +1430,14 @@ async def handle_name_input(message: Message, state: FSMContext):
     else:
         soft_name = text
         
-    await execute_query("UPDATE users SET soft_name = $1 WHERE user_id = $2", soft_name, message.from_user.id)
+    row = await fetch_one(SQL_SET_SOFT_NAME, soft_name, message.from_user.id)
+    invalidate_user_profile(message.from_user.id)
+    seen = bool(row and row["seen_instructions"])
     prefix = get_addressing(soft_name)
     await state.clear()
-    
-    # Безопасное получение флага инструкции
-    try:
-        rows = await execute_query("SELECT seen_instructions FROM users WHERE user_id = $1", message.from_user.id)
-        seen = rows[0]["seen_instructions"] if rows else False
-    except Exception:
-        seen = False
 
     if not seen:
         try:
-            await execute_query("UPDATE users SET seen_instructions = TRUE WHERE user_id = $1", message.from_user.id)
             await message.answer(
                 f"{prefix}дневник открыт. 🌿\n\n"
                 "Вот как им пользоваться:\n\n"
@@ -905,6 +1466,165 @@ async def handle_name_input(message: Message, state: FSMContext):
         )
 
 # === ДОБАВЛЕНИЕ ЗАПИСЕЙ ===
+# Записи, активность пользователя и счётчики user_stats меняются одним запросом — сразу
+# для пачки записей. Записи одного пользователя в пачке сворачиваются в одну строку: строку
+# нельзя обновить дважды за запрос. created_at у всей пачки общий (NOW() транзакции),
+# поэтому и день серии — местный, в поясе пользователя — у них один
+SQL_SAVE_ENTRIES = named_sql("save_entries", """
+    WITH entry AS (
+        INSERT INTO entries (user_id, text, entry_type)
+        SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[])
+        RETURNING user_id, entry_type, created_at
+    ), per_user AS (
+        SELECT user_id, COUNT(*) AS entries, MIN(created_at) AS first_at, MAX(created_at) AS last_at,
+            COUNT(*) FILTER (WHERE entry_type = 'achievement') AS achievements,
+            COUNT(*) FILTER (WHERE entry_type = 'gratitude') AS gratitudes,
+            COUNT(*) FILTER (WHERE entry_type = 'free') AS free_entries,
+            COUNT(*) FILTER (WHERE entry_type = 'here_and_now') AS here_and_now_entries
+        FROM entry
+        GROUP BY user_id
+    ), activity AS (
+        UPDATE users u
+        SET last_entry_at = GREATEST(u.last_entry_at, p.last_at), entry_count = u.entry_count + p.entries
+        FROM per_user p
+        WHERE u.user_id = p.user_id
+        RETURNING p.*, ((p.last_at AT TIME ZONE 'UTC') AT TIME ZONE COALESCE(u.timezone, $4))::date AS day
+    )
+    INSERT INTO user_stats AS s (
+        user_id, achievements, gratitudes, free_entries, here_and_now_entries,
+        first_entry_at, streak_day, current_streak, longest_streak, week_start, week_entries
+    )
+    SELECT user_id, achievements, gratitudes, free_entries, here_and_now_entries,
+        first_at, day, 1, 1, date_trunc('week', day)::date, entries
+    FROM activity
+    ON CONFLICT (user_id) DO UPDATE SET
+        achievements = s.achievements + EXCLUDED.achievements,
+        gratitudes = s.gratitudes + EXCLUDED.gratitudes,
+        free_entries = s.free_entries + EXCLUDED.free_entries,
+        here_and_now_entries = s.here_and_now_entries + EXCLUDED.here_and_now_entries,
+        first_entry_at = LEAST(s.first_entry_at, EXCLUDED.first_entry_at),
+        current_streak = CASE
+            WHEN s.streak_day >= EXCLUDED.streak_day THEN s.current_streak
+            WHEN s.streak_day = EXCLUDED.streak_day - 1 THEN s.current_streak + 1
+            ELSE 1
+        END,
+        longest_streak = GREATEST(s.longest_streak, CASE
+            WHEN s.streak_day >= EXCLUDED.streak_day THEN s.current_streak
+            WHEN s.streak_day = EXCLUDED.streak_day - 1 THEN s.current_streak + 1
+            ELSE 1
+        END),
+        streak_day = GREATEST(s.streak_day, EXCLUDED.streak_day),
+        week_entries = CASE
+            WHEN s.week_start = EXCLUDED.week_start THEN s.week_entries + EXCLUDED.week_entries
+            ELSE EXCLUDED.week_entries
+        END,
+        week_start = EXCLUDED.week_start
+""")
+
+async def write_entries(entries):
+    # entries: [(user_id, text, entry_type)]
+    user_ids, texts, entry_types = zip(*entries)
+    await execute_query(SQL_SAVE_ENTRIES, list(user_ids), list(texts), list(entry_types), DEFAULT_TIMEZONE)
+
+# === ГРУППОВАЯ ЗАПИСЬ ===
+# Под всплеском (все отвечают на вечерний вопрос в 20:00) записи копятся до ENTRY_BATCH_MAX_ROWS
+# или ENTRY_BATCH_MAX_DELAY_MS и уходят одним запросом и одним коммитом. Обработчик ждёт
+# коммита своей пачки, поэтому «Записано» по-прежнему значит «уже в базе»
+ENTRY_BATCHING = os.getenv("ENTRY_BATCHING", "false").lower() == "true"
+ENTRY_BATCH_MAX_ROWS = int(os.getenv("ENTRY_BATCH_MAX_ROWS", "100"))
+ENTRY_BATCH_MAX_DELAY_MS = float(os.getenv("ENTRY_BATCH_MAX_DELAY_MS", "5"))
+
+class EntryBatcher:
+    def __init__(self, max_rows=ENTRY_BATCH_MAX_ROWS, max_delay_ms=ENTRY_BATCH_MAX_DELAY_MS):
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self._pending = []  # [((user_id, text, entry_type), future, queued_at)]
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, user_id, text, entry_type):
+        if self._closing or self._task is None:
+            await write_entries([(user_id, text, entry_type)])
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((user_id, text, entry_type), future, time.perf_counter()))
+        self._wakeup.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        await future
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Первая запись пачки ждёт соседей не дольше max_delay; пока идёт предыдущий
+            # коммит, очередь копится сама, и следующая пачка уходит без ожидания
+            if len(self._pending) < self.max_rows and not self._closing:
+                self._full.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+            batch = self._pending[:self.max_rows]
+            del self._pending[:self.max_rows]
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            await write_entries([entry for entry, _, _ in batch])
+        except Exception as exc:
+            if len(batch) == 1:
+                self._resolve(batch, exc)
+            else:
+                # Одна плохая запись не должна ронять соседей: пачку дописываем по одной
+                print(f"Entry batch of {len(batch)} failed, retrying one by one: {exc}")
+                for item in batch:
+                    try:
+                        await write_entries([item[0]])
+                        self._resolve([item])
+                    except Exception as item_exc:
+                        self._resolve([item], item_exc)
+        else:
+            self._resolve(batch)
+        finished = time.perf_counter()
+        entry_batch_rows.observe(len(batch))
+        entry_batch_flush.observe(finished - started)
+        for _, _, queued_at in batch:
+            entry_batch_wait.observe(finished - queued_at)
+
+    def _resolve(self, batch, exc=None):
+        for _, future, _ in batch:
+            # Обработчик могли отменить, пока запись ждала коммита
+            if future.done():
+                continue
+            if exc is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exc)
+
+    async def close(self):
+        # Всё, что уже в очереди, дописываем; новые записи идут в базу напрямую
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        if self._task is not None:
+            await self._task
+
+entry_batcher = None
+
+async def save_entry(user_id, text, entry_type):
+    if entry_batcher is not None:
+        await entry_batcher.add(user_id, text, entry_type)
+    else:
+        await write_entries([(user_id, text, entry_type)])
 
 @router.message(F.text == "🌱 Добавить достижение")
 async def add_achievement_start(message: Message, state: FSMContext):
@@ -914,10 +1634,7 @@ async def add_achievement_start(message: Message, state: FSMContext):
 @router.message(JournalStates.waiting_for_achievement)
 async def add_achievement_save(message: Message, state: FSMContext):
     text = message.text.strip()
-    await execute_query(
-        "INSERT INTO entries (user_id, text, entry_type) VALUES ($1, $2, 'achievement')",
-        message.from_user.id, text
-    )
+    await save_entry(message.from_user.id, text, "achievement")
     await state.clear()
     await message.answer(
         "Достижение добавлено. 🌱",
@@ -932,10 +1649,7 @@ async def add_gratitude_start(message: Message, state: FSMContext):
 @router.message(JournalStates.waiting_for_gratitude)
 async def add_gratitude_save(message: Message, state: FSMContext):
     text = message.text.strip()
-    await execute_query(
-        "INSERT INTO entries (user_id, text, entry_type) VALUES ($1, $2, 'gratitude')",
-        message.from_user.id, text
-    )
+    await save_entry(message.from_user.id, text, "gratitude")
     await state.clear()
     await message.answer(
         "Благодарность добавлена. 🤍",
@@ -950,10 +1664,7 @@ async def add_entry_start(message: Message, state: FSMContext):
 @router.message(JournalStates.waiting_for_entry)
 async def add_entry_save(message: Message, state: FSMContext):
     text = message.text.strip()
-    await execute_query(
-        "INSERT INTO entries (user_id, text, entry_type) VALUES ($1, $2, 'free')",
-        message.from_user.id, text
-    )
+    await save_entry(message.from_user.id, text, "free")
     await state.clear()
     await message.answer(
         "Записано. ✨",
@@ -961,45 +1672,146 @@ async def add_entry_save(message: Message, state: FSMContext):
     )
 
 # === ПРОСМОТР ЗАПИСЕЙ ===
+# Постранично, keyset-пагинация по (created_at, id): одна страница — один запрос,
+# размер страницы ограничен длиной текста (Telegram режет сообщения на 4096 символах).
+# Telegram считает длину в кодовых единицах UTF-16: эмодзи — две единицы, а для len() — один символ
+PAGE_MAX_CHARS = int(os.getenv("PAGE_MAX_CHARS", "3500"))
+PAGE_MAX_ROWS = int(os.getenv("PAGE_MAX_ROWS", "20"))
+PAGE_CALLBACK_PREFIX = "jp"
+EPOCH = datetime(1970, 1, 1)
+
+ENTRY_VIEWS = {
+    "a": ("achievement", "Твои достижения"),
+    "g": ("gratitude", "Твои благодарности"),
+    "f": ("free", "Твои записи"),
+}
+
+SQL_PAGE_LATEST = named_sql("entries_page_latest", """
+    SELECT id, text, created_at FROM entries
+    WHERE user_id = $1 AND entry_type = $2
+    ORDER BY created_at DESC, id DESC
+    LIMIT $3
+""")
+
+SQL_PAGE_OLDER = named_sql("entries_page_older", """
+    SELECT id, text, created_at FROM entries
+    WHERE user_id = $1 AND entry_type = $2 AND (created_at, id) < ($3, $4)
+    ORDER BY created_at DESC, id DESC
+    LIMIT $5
+""")
+
+SQL_PAGE_NEWER = named_sql("entries_page_newer", """
+    SELECT id, text, created_at FROM entries
+    WHERE user_id = $1 AND entry_type = $2 AND (created_at, id) > ($3, $4)
+    ORDER BY created_at ASC, id ASC
+    LIMIT $5
+""")
+
+EMPTY_JOURNAL_TEXT = "Это пространство ждёт твои слова.\nКогда захочешь — просто напиши. 🤍"
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def utf16_truncate(text, limit):
+    # Половинку суррогатной пары на границе отбрасываем
+    return text.encode("utf-16-le")[:limit * 2].decode("utf-16-le", errors="ignore")
+
+def encode_page_cursor(row):
+    return f"{(row['created_at'] - EPOCH) // timedelta(microseconds=1)}:{row['id']}"
+
+def decode_page_cursor(created_us, entry_id):
+    return EPOCH + timedelta(microseconds=int(created_us)), int(entry_id)
+
+def page_button(text, view, direction, row):
+    return InlineKeyboardButton(
+        text=text,
+        callback_data=f"{PAGE_CALLBACK_PREFIX}:{view}:{direction}:{encode_page_cursor(row)}"
+    )
 
-@router.message(F.text == "🌱 Мои достижения")
-async def show_achievements(message: Message):
-    rows = await execute_query("""
-        SELECT text FROM entries 
-        WHERE user_id = $1 AND entry_type = 'achievement'
-        ORDER BY created_at DESC
-    """, message.from_user.id)
+async def render_entries_page(user_id, view, direction="latest", cursor=None):
+    entry_type, title = ENTRY_VIEWS[view]
+    # +1 строка, чтобы без COUNT(*) узнать, есть ли что-то дальше
+    if direction == "older":
+        rows = await fetch_all(SQL_PAGE_OLDER, user_id, entry_type, *cursor, PAGE_MAX_ROWS + 1)
+    elif direction == "newer":
+        rows = await fetch_all(SQL_PAGE_NEWER, user_id, entry_type, *cursor, PAGE_MAX_ROWS + 1)
+    else:
+        rows = await fetch_all(SQL_PAGE_LATEST, user_id, entry_type, PAGE_MAX_ROWS + 1)
     if not rows:
-        await message.answer("Это пространство ждёт твои слова.\nКогда захочешь — просто напиши. 🤍")
+        return None
+
+    header = f"{title}:\n\n"
+    budget = PAGE_MAX_CHARS - utf16_len(header)
+    page = []
+    for row in rows[:PAGE_MAX_ROWS]:
+        item = f"• {row['text']}"
+        if page and utf16_len(item) + 2 > budget:
+            break
+        if utf16_len(item) > budget:
+            item = utf16_truncate(item, budget - 1) + "…"
+        page.append((row, item))
+        budget -= utf16_len(item) + 2
+    has_more = len(rows) > len(page)
+
+    # Внутри страницы — от старых к новым, как раньше
+    if direction != "newer":
+        page.reverse()
+    has_older = has_more if direction != "newer" else True
+    has_newer = has_more if direction == "newer" else direction == "older"
+
+    buttons = []
+    if has_older:
+        buttons.append(page_button("⬅️ Раньше", view, "older", page[0][0]))
+    if has_newer:
+        buttons.append(page_button("Позже ➡️", view, "newer", page[-1][0]))
+    markup = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    text = header + "\n\n".join(item for _, item in page)
+    return text, markup
+
+async def _show_entries(message: Message, view: str):
+    page = await render_entries_page(message.from_user.id, view)
+    if page is None:
+        await message.answer(EMPTY_JOURNAL_TEXT)
         return
-    entries = "\n\n".join(f"• {row['text']}" for row in reversed(rows))
-    await message.answer(f"Твои достижения:\n\n{entries}")
+    text, markup = page
+    await message.answer(text, reply_markup=markup)
+
+@router.message(F.text == "🌱 Мои достижения")
+async def show_achievements(message: Message):
+    await _show_entries(message, "a")
 
 @router.message(F.text == "🤍 Мои благодарности")
 async def show_gratitudes(message: Message):
-    rows = await execute_query("""
-        SELECT text FROM entries 
-        WHERE user_id = $1 AND entry_type = 'gratitude'
-        ORDER BY created_at DESC
-    """, message.from_user.id)
-    if not rows:
-        await message.answer("Это пространство ждёт твои слова.\nКогда захочешь — просто напиши. 🤍")
-        return
-    entries = "\n\n".join(f"• {row['text']}" for row in reversed(rows))
-    await message.answer(f"Твои благодарности:\n\n{entries}")
+    await _show_entries(message, "g")
 
 @router.message(F.text == "📜 Мои записи")
 async def show_entries(message: Message):
-    rows = await execute_query("""
-        SELECT text FROM entries 
-        WHERE user_id = $1 AND entry_type = 'free'
-        ORDER BY created_at DESC
-    """, message.from_user.id)
-    if not rows:
-        await message.answer("Это пространство ждёт твои слова.\nКогда захочешь — просто напиши. 🤍")
+    await _show_entries(message, "f")
+
+@router.callback_query(F.data.startswith(f"{PAGE_CALLBACK_PREFIX}:"))
+async def paginate_entries(callback: CallbackQuery):
+    try:
+        _, view, direction, created_us, entry_id = callback.data.split(":")
+        cursor = decode_page_cursor(created_us, entry_id)
+    except ValueError:
+        await callback.answer()
+        return
+    if view not in ENTRY_VIEWS or direction not in ("older", "newer"):
+        await callback.answer()
+        return
+    page = await render_entries_page(callback.from_user.id, view, direction, cursor)
+    if page is None:
+        await callback.answer("Здесь больше ничего нет. 🤍")
         return
-    entries = "\n\n".join(f"• {row['text']}" for row in reversed(rows))
-    await message.answer(f"Твои записи:\n\n{entries}")
+    text, markup = page
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as exc:
+        # Двойное нажатие: страница уже на экране
+        if "message is not modified" not in exc.message.lower():
+            raise
+    finally:
+        await callback.answer()
 
 # === УДАЛЕНИЕ ===
 
@@ -1019,11 +1831,14 @@ async def delete_all_start(message: Message):
 
 @router.message(F.text == "Да, удалить всё")
 async def delete_all_confirm(message: Message):
-    await execute_query("DELETE FROM entries WHERE user_id = $1", message.from_user.id)
-    await execute_query(
-        "UPDATE users SET soft_name = NULL WHERE user_id = $1",
-        message.from_user.id
-    )
+    async with db_transaction() as conn:
+        await execute_query("DELETE FROM entries WHERE user_id = $1", message.from_user.id, conn=conn)
+        await execute_query("DELETE FROM user_stats WHERE user_id = $1", message.from_user.id, conn=conn)
+        await execute_query(
+            "UPDATE users SET soft_name = NULL, last_entry_at = NULL, entry_count = 0 WHERE user_id = $1",
+            message.from_user.id, conn=conn
+        )
+    invalidate_user_profile(message.from_user.id)
     await message.answer(
         "Все твои записи удалены. 🤍\n\n"
         "Если захочешь начать заново — просто напиши сюда.\n"
@@ -1065,33 +1880,206 @@ async def here_and_now_save(message: Message, state: FSMContext):
         await message.answer("Можешь написать хоть слово. Я слушаю. 🌙")
         return
     
-    await execute_query(
-        "INSERT INTO entries (user_id, text, entry_type) VALUES ($1, $2, 'here_and_now')",
-        message.from_user.id, text
-    )
+    await save_entry(message.from_user.id, text, "here_and_now")
     await state.clear()
     await message.answer("Ты здесь и сейчас. Почувствуй это. 💚")
 
+# === ЧАСОВОЙ ПОЯС ===
+TIMEZONES_BY_LOWER = {name.lower(): name for name in pytz.all_timezones}
+UTC_OFFSET_RE = re.compile(r"(?:UTC|GMT)?\s*([+-])\s*(\d{1,2})(?::?00)?", re.IGNORECASE)
+
+def parse_timezone(value):
+    value = value.strip()
+    match = UTC_OFFSET_RE.fullmatch(value)
+    if match:
+        hours = int(match.group(2))
+        if hours == 0:
+            return "UTC"
+        if hours > 14 or (match.group(1) == "-" and hours > 12):
+            return None
+        # В базе tz у зон Etc/GMT знак обратный: UTC+3 — это Etc/GMT-3
+        return f"Etc/GMT{'-' if match.group(1) == '+' else '+'}{hours}"
+    return TIMEZONES_BY_LOWER.get(value.lower())
+
+def describe_timezone(timezone):
+    if timezone.startswith("Etc/GMT") and len(timezone) > len("Etc/GMT"):
+        offset = timezone[len("Etc/GMT"):]
+        return f"UTC{'+' if offset[0] == '-' else '-'}{offset[1:]}"
+    return timezone
+
+@router.message(F.text.startswith("/timezone"))
+async def set_timezone(message: Message):
+    argument = message.text[len("/timezone"):].strip()
+    if not argument:
+        current = await fetch_value("SELECT timezone FROM users WHERE user_id = $1", message.from_user.id)
+        await message.answer(
+            f"Сейчас я пишу тебе по времени {describe_timezone(current or DEFAULT_TIMEZONE)}.\n\n"
+            "Чтобы изменить, напиши, например:\n"
+            "/timezone Europe/Moscow\n"
+            "/timezone +5"
+        )
+        return
+    timezone = parse_timezone(argument)
+    if timezone is None:
+        await message.answer(
+            "Не получилось узнать этот часовой пояс. 🌙\n"
+            "Попробуй так: /timezone Asia/Yekaterinburg или /timezone +5"
+        )
+        return
+    now = datetime.utcnow()
+    status = await execute_query("""
+        UPDATE users
+        SET timezone = $2,
+            next_affirmation_at = next_local_time($2, $3, $5),
+            next_question_at = next_local_time($2, $4, $5)
+        WHERE user_id = $1
+    """, message.from_user.id, timezone, AFFIRMATION_LOCAL_TIME, QUESTION_LOCAL_TIME, now)
+    if not affected_rows(status):
+        await message.answer("Сначала открой дневник командой /start. 🤍")
+        return
+    await message.answer(
+        f"Готово. Утренние слова придут в {AFFIRMATION_LOCAL_TIME:%H:%M}, "
+        f"вечерний вопрос — в {QUESTION_LOCAL_TIME:%H:%M} по времени {describe_timezone(timezone)}. 🌿"
+    )
+
+# === ТИШИНА ===
+# silence_until хранится только у тех, кто молчит сейчас: истёкшие сроки сбрасывает
+# end_expired_silences, поэтому фильтр рассылок (REACHABLE_USERS) — простое silence_until IS NULL
+SILENCE_MAX_DAYS = int(os.getenv("SILENCE_MAX_DAYS", "365"))
+SILENCE_DURATION_RE = re.compile(r"(\d{1,9})\s*([a-zа-яё]*)", re.IGNORECASE)
+SILENCE_UNITS = (
+    (("mo", "мес"), timedelta(days=30)),
+    (("m", "м"), timedelta(minutes=1)),
+    (("h", "ч"), timedelta(hours=1)),
+    (("d", "д", "с"), timedelta(days=1)),
+    (("w", "н"), timedelta(weeks=1)),
+)
+
+# Снятие тишины: сроки доставки пересчитываются от текущего момента,
+# чтобы не прислать утреннюю аффирмацию посреди дня
+SQL_END_SILENCE = """
+    UPDATE users
+    SET silence_until = NULL,
+        next_affirmation_at = next_local_time(COALESCE(timezone, $2), $3, $1),
+        next_question_at = next_local_time(COALESCE(timezone, $2), $4, $1)
+    WHERE {condition}
+"""
+
+def parse_silence_duration(value):
+    match = SILENCE_DURATION_RE.fullmatch(value.strip())
+    if not match or int(match.group(1)) == 0:
+        return None
+    amount, unit = int(match.group(1)), match.group(2).lower()
+    step = timedelta(days=1) if not unit else next(
+        (step for prefixes, step in SILENCE_UNITS if unit.startswith(prefixes)), None
+    )
+    # Предел проверяем до умножения: огромное число не должно переполнить timedelta
+    if step is None or amount > timedelta(days=SILENCE_MAX_DAYS) // step:
+        return None
+    return step * amount
+
+async def end_expired_silences():
+    now = datetime.utcnow()
+    status = await execute_query(
+        SQL_END_SILENCE.format(condition="silence_until <= $1"),
+        now, DEFAULT_TIMEZONE, AFFIRMATION_LOCAL_TIME, QUESTION_LOCAL_TIME
+    )
+    if affected_rows(status):
+        print(f"🔔 Silence ended for {affected_rows(status)} users")
+
+@router.message(F.text.startswith("/silence"))
+async def set_silence(message: Message):
+    argument = message.text[len("/silence"):].strip()
+    duration = parse_silence_duration(argument) if argument else None
+    if duration is None:
+        await message.answer(
+            "Я могу помолчать — без аффирмаций, вопросов и напоминаний. 🌙\n\n"
+            "Напиши, на сколько, например:\n"
+            "/silence 3d — на три дня\n"
+            "/silence 2w — на две недели\n"
+            "/silence 12h — до завтра\n\n"
+            "Вернуть всё как было — /unsilence"
+        )
+        return
+    until = datetime.utcnow() + duration
+    async with db_transaction() as conn:
+        timezone = await fetch_value("""
+            UPDATE users SET silence_until = $2 WHERE user_id = $1
+            RETURNING COALESCE(timezone, $3)
+        """, message.from_user.id, until, DEFAULT_TIMEZONE, conn=conn)
+        if timezone is not None:
+            # То, что уже стоит в очереди, тоже не отправляем
+            await execute_query(
+                "DELETE FROM outbox WHERE chat_id = $1 AND status = 'pending'",
+                message.from_user.id, conn=conn
+            )
+    # Отвечаем после транзакции: сетевой вызов не держит соединение пула
+    if timezone is None:
+        await message.answer("Сначала открой дневник командой /start. 🤍")
+        return
+    local_until = pytz.utc.localize(until).astimezone(pytz.timezone(timezone))
+    await message.answer(
+        f"Хорошо. Я помолчу до {local_until:%d.%m %H:%M}. 🤍\n"
+        "Дневник при этом открыт — пиши, когда захочешь.\n"
+        "Вернуться раньше — /unsilence"
+    )
+
+@router.message(F.text == "/unsilence")
+async def end_silence(message: Message):
+    status = await execute_query(
+        SQL_END_SILENCE.format(condition="user_id = $5 AND silence_until IS NOT NULL"),
+        datetime.utcnow(), DEFAULT_TIMEZONE, AFFIRMATION_LOCAL_TIME, QUESTION_LOCAL_TIME,
+        message.from_user.id
+    )
+    if not affected_rows(status):
+        await message.answer("Я и так рядом. 🌿")
+        return
+    await message.answer("Я снова рядом. Утренние слова и вечерние вопросы вернутся в своё время. 🌿")
+
 # === СВОДКА ===
+def plural(n, one, few, many):
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+# Готовые счётчики из user_stats — поиск по первичному ключу вместо агрегатов по entries
+SQL_SUMMARY = named_sql("summary", """
+    SELECT s.achievements, s.gratitudes, s.free_entries + s.here_and_now_entries AS entries,
+        s.streak_day, s.current_streak, s.longest_streak, s.week_start, s.week_entries,
+        COALESCE(u.timezone, $2) AS timezone
+    FROM user_stats s
+    JOIN users u ON u.user_id = s.user_id
+    WHERE s.user_id = $1
+""")
+
 @router.message(F.text == "/summary")
 async def send_summary(message: Message):
-    rows = await execute_query("""
-        SELECT 
-            COUNT(*) FILTER (WHERE entry_type = 'achievement') AS achievements,
-            COUNT(*) FILTER (WHERE entry_type = 'gratitude') AS gratitudes,
-            COUNT(*) FILTER (WHERE entry_type = 'free' OR entry_type = 'here_and_now') AS entries
-        FROM entries WHERE user_id = $1
-    """, message.from_user.id)
-    
-    a = rows[0]["achievements"]
-    g = rows[0]["gratitudes"]
-    e = rows[0]["entries"]
-    
+    row = await fetch_one(SQL_SUMMARY, message.from_user.id, DEFAULT_TIMEZONE)
+    a = row["achievements"] if row else 0
+    g = row["gratitudes"] if row else 0
+    e = row["entries"] if row else 0
+    lines = [
+        f"• {a} достижений",
+        f"• {g} благодарностей",
+        f"• {e} записей",
+    ]
+    if row:
+        today = datetime.now(pytz.timezone(row["timezone"])).date()
+        # Серия жива, пока пропущено не больше сегодняшнего дня
+        streak = row["current_streak"] if row["streak_day"] >= today - timedelta(days=1) else 0
+        week = row["week_entries"] if row["week_start"] == today - timedelta(days=today.weekday()) else 0
+        if week:
+            lines.append(f"• {week} {plural(week, 'запись', 'записи', 'записей')} за эту неделю")
+        if streak > 1:
+            lines.append(f"• {streak} {plural(streak, 'день', 'дня', 'дней')} подряд")
+        if row["longest_streak"] > max(streak, 1):
+            longest = row["longest_streak"]
+            lines.append(f"• самая длинная серия — {longest} {plural(longest, 'день', 'дня', 'дней')}")
+
     await message.answer(
-        f"Ты написал(а):\n"
-        f"• {a} достижений\n"
-        f"• {g} благодарностей\n"
-        f"• {e} записей\n\n"
+        "Ты написал(а):\n" + "\n".join(lines) + "\n\n"
         "Спасибо, что доверяешь мне свои слова. 💚"
     )
 
@@ -1131,11 +2119,9 @@ async def show_paysupport(message: Message):
 
 @router.message(F.text == "/help")
 async def show_help(message: Message):
-    prefix = ""
-    user = await execute_query("SELECT soft_name FROM users WHERE user_id = $1", message.from_user.id)
-    if user and user[0]["soft_name"]:
-        prefix = f"{user[0]['soft_name']}, "
-    
+    profile = await get_user_profile(message.from_user.id)
+    prefix = get_addressing(profile.soft_name if profile else None)
+
     await message.answer(
         f"{prefix}вот как пользоваться дневником:\n\n"
         "🌱 <b>Добавить достижение</b> — отметь даже маленький успех\n"
@@ -1147,147 +2133,1058 @@ async def show_help(message: Message):
         parse_mode="HTML"
     )
 
-# === ЕЖЕДНЕВНЫЕ АФФИРМАЦИИ ===
-async def _send_affirmations(bot: Bot, prefix: str, log_label: str):
-    users = await execute_query("SELECT user_id FROM users")
-    for user in users:
+# === РАССЫЛКИ: ОГРАНИЧЕНИЕ СКОРОСТИ И ПОВТОРЫ ===
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений/сек, глобальный лимит Telegram ~30
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_MAX_FLOOD_WAITS = int(os.getenv("BROADCAST_MAX_FLOOD_WAITS", "10"))
+
+SEND_OK = "sent"
+SEND_BLOCKED = "blocked"
+SEND_DEACTIVATED = "deactivated"
+SEND_CHAT_NOT_FOUND = "chat_not_found"
+SEND_FAILED = "failed"
+
+# Результаты, после которых писать пользователю бессмысленно, пока он сам не вернётся через /start
+UNDELIVERABLE = (SEND_BLOCKED, SEND_DEACTIVATED, SEND_CHAT_NOT_FOUND)
+
+def undeliverable_result(exc):
+    description = exc.message.lower()
+    if "deactivated" in description:
+        return SEND_DEACTIVATED
+    if "chat not found" in description or "user not found" in description:
+        return SEND_CHAT_NOT_FOUND
+    if isinstance(exc, TelegramForbiddenError):
+        return SEND_BLOCKED
+    return None
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    parse_mode: str = None
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # После 429 все отправители ждут retry_after, а ведро начинает с нуля
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+class TelegramRateLimiter:
+    def __init__(self, rate, burst, per_chat_interval):
+        self.bucket = TokenBucket(rate, burst)
+        self.per_chat_interval = per_chat_interval
+        self._last_sent = {}
+
+    async def acquire(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            wait = last + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        await self.bucket.acquire()
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        if len(self._last_sent) > 10000:
+            self._last_sent = {
+                chat: sent_at for chat, sent_at in self._last_sent.items()
+                if now - sent_at < self.per_chat_interval
+            }
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+telegram_limiter = TelegramRateLimiter(BROADCAST_RATE, BROADCAST_BURST, BROADCAST_PER_CHAT_INTERVAL)
+
+@dataclass
+class BroadcastStats:
+    job: str
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def report(self):
+        elapsed = self.elapsed
+        rate = self.sent / elapsed if elapsed > 0 else 0.0
+        print(
+            f"📬 {self.job}: sent={self.sent} failed={self.failed} blocked={self.blocked} "
+            f"retries={self.retries} in {elapsed:.1f}s ({rate:.1f} msg/s)"
+        )
+
+class Broadcaster:
+    def __init__(self, bot: Bot, job: str):
+        self.bot = bot
+        self.stats = BroadcastStats(job)
+        self._semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(self, message: OutgoingMessage):
+        attempt = 0
+        flood_waits = 0
+        while True:
+            await telegram_limiter.acquire(message.chat_id)
+            try:
+                await self.bot.send_message(message.chat_id, message.text, parse_mode=message.parse_mode)
+                self.stats.sent += 1
+                return SEND_OK
+            except TelegramRetryAfter as exc:
+                flood_waits += 1
+                telegram_limiter.pause(exc.retry_after)
+                if flood_waits > BROADCAST_MAX_FLOOD_WAITS:
+                    print(f"{self.stats.job}: flood control did not clear for {message.chat_id}")
+                    self.stats.failed += 1
+                    return SEND_FAILED
+                self.stats.retries += 1
+            except (TelegramForbiddenError, TelegramBadRequest) as exc:
+                result = undeliverable_result(exc)
+                if result is None:
+                    print(f"{self.stats.job} send error for {message.chat_id}: {exc}")
+                    self.stats.failed += 1
+                    return SEND_FAILED
+                self.stats.blocked += 1
+                return result
+            except (TelegramNetworkError, TelegramServerError) as exc:
+                attempt += 1
+                if attempt > BROADCAST_MAX_RETRIES:
+                    print(f"{self.stats.job} send error for {message.chat_id}: {exc}")
+                    self.stats.failed += 1
+                    return SEND_FAILED
+                self.stats.retries += 1
+                await asyncio.sleep(0.5 * 2 ** attempt + random.random() * 0.5)
+            except Exception as exc:
+                print(f"{self.stats.job} send error for {message.chat_id}: {exc}")
+                self.stats.failed += 1
+                return SEND_FAILED
+
+    async def _send_bounded(self, message: OutgoingMessage):
+        async with self._semaphore:
+            return await self.send(message)
+
+    async def send_many(self, messages):
+        return await asyncio.gather(*(self._send_bounded(message) for message in messages))
+
+# === РАССЫЛКИ: ОЧЕРЕДЬ OUTBOX ===
+# Производство и доставка разделены: задания и обработчики ставят сообщения в таблицу outbox,
+# пул воркеров забирает пачки через FOR UPDATE SKIP LOCKED — воркеры не возьмут одну строку дважды.
+# Лимит Telegram один на токен, а telegram_limiter — на процесс, поэтому воркеры работают
+# только на лидере (см. scheduler_leader): N реплик не шлют N × BROADCAST_RATE.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = int(os.getenv("OUTBOX_RETRY_DELAY", "30"))
+OUTBOX_REPORT_INTERVAL = int(os.getenv("OUTBOX_REPORT_INTERVAL", "60"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+# Аффирмации и вопросы привязаны к местному времени — они обгоняют остальные рассылки
+OUTBOX_PRIORITY_HIGH = 10
+OUTBOX_PRIORITY_LOW = 0
+
+OUTBOX_PENDING = "pending"
+
+SQL_OUTBOX_ENQUEUE = named_sql("outbox_enqueue", """
+    INSERT INTO outbox (chat_id, text, parse_mode, priority, not_before, job, run_key)
+    SELECT m.chat_id, m.text, m.parse_mode, $4, $5, $6, $7
+    FROM unnest($1::bigint[], $2::text[], $3::text[]) AS m(chat_id, text, parse_mode)
+""")
+
+SQL_OUTBOX_CLAIM = named_sql("outbox_claim", """
+    UPDATE outbox SET attempts = attempts + 1, not_before = $3
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE status = 'pending' AND not_before <= $2
+        ORDER BY priority DESC, not_before, id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, text, parse_mode, job, run_key, attempts
+""")
+
+# Пачка с flood wait и повторами может отправляться дольше аренды — пока она в работе,
+# аренду продлевает deliver, иначе строки заберут повторно и сообщения уйдут дважды
+SQL_OUTBOX_RENEW = named_sql("outbox_renew", """
+    UPDATE outbox SET not_before = $2
+    WHERE id = ANY($1::bigint[]) AND status = 'pending'
+""")
+
+SQL_OUTBOX_FINISH = named_sql("outbox_finish", """
+    UPDATE outbox AS o
+    SET status = r.status, not_before = r.not_before,
+        finished_at = CASE WHEN r.status = 'pending' THEN NULL ELSE $4::timestamp END
+    FROM unnest($1::bigint[], $2::text[], $3::timestamp[]) AS r(id, status, not_before)
+    WHERE o.id = r.id
+""")
+
+SQL_MARK_UNDELIVERABLE = named_sql("mark_undeliverable", """
+    UPDATE users AS u SET delivery_status = r.status
+    FROM unnest($1::bigint[], $2::text[]) AS r(user_id, status)
+    WHERE u.user_id = r.user_id
+""")
+
+SQL_OUTBOX_RUN_TOTALS = named_sql("outbox_run_totals", """
+    UPDATE broadcast_runs AS b
+    SET sent = b.sent + t.sent, failed = b.failed + t.failed, blocked = b.blocked + t.blocked
+    FROM unnest($1::text[], $2::text[], $3::int[], $4::int[], $5::int[])
+        AS t(job, run_key, sent, failed, blocked)
+    WHERE b.job = t.job AND b.run_key = t.run_key
+""")
+
+async def enqueue_messages(messages, job, priority=OUTBOX_PRIORITY_LOW, not_before=None, run_key=None, conn=None):
+    if not messages:
+        return 0
+    await execute_query(
+        SQL_OUTBOX_ENQUEUE,
+        [message.chat_id for message in messages],
+        [message.text for message in messages],
+        [message.parse_mode for message in messages],
+        priority, not_before or datetime.utcnow(), job, run_key,
+        conn=conn
+    )
+    return len(messages)
+
+def outbox_retry_at(attempts, now):
+    return now + timedelta(seconds=min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), 3600))
+
+class OutboxDispatcher:
+    def __init__(self, bot: Bot, workers=OUTBOX_WORKERS):
+        # Один Broadcaster на процесс: общий семафор и общий лимит Telegram на все воркеры
+        self.broadcaster = Broadcaster(bot, "Outbox")
+        self.workers = workers
+        self._tasks = []
+        self._stopping = asyncio.Event()
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        # У каждого запуска своё событие: воркеры прошлого запуска могут ещё дописывать пачку
+        self._stopping = asyncio.Event()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        self._tasks += [asyncio.create_task(self._worker(self._stopping)) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Текущие пачки дописываются до конца, новые не берутся
+        self._running = False
+        self._stopping.set()
+        await asyncio.gather(*self._tasks)
+
+    async def claim(self):
+        now = datetime.utcnow()
+        return await fetch_all(
+            SQL_OUTBOX_CLAIM, OUTBOX_BATCH_SIZE, now, now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        )
+
+    async def renew_lease(self, ids):
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+            try:
+                await execute_query(
+                    SQL_OUTBOX_RENEW, ids, datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+                )
+            except Exception as exc:
+                print(f"Outbox lease renewal error: {exc}")
+
+    async def deliver(self, rows):
+        renewal = asyncio.create_task(self.renew_lease([row["id"] for row in rows]))
+        try:
+            results = await self.broadcaster.send_many([
+                OutgoingMessage(row["chat_id"], row["text"], row["parse_mode"]) for row in rows
+            ])
+        finally:
+            renewal.cancel()
+            with suppress(asyncio.CancelledError):
+                await renewal
+        now = datetime.utcnow()
+        statuses, retry_at, totals, unreachable = [], [], {}, {}
+        for row, result in zip(rows, results):
+            if result == SEND_FAILED and row["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                statuses.append(OUTBOX_PENDING)
+                retry_at.append(outbox_retry_at(row["attempts"], now))
+                continue
+            statuses.append(result)
+            retry_at.append(now)
+            broadcast_messages.inc(row["job"], result)
+            if result in UNDELIVERABLE:
+                unreachable[row["chat_id"]] = result
+            if row["run_key"] is not None:
+                counts = totals.setdefault((row["job"], row["run_key"]), {SEND_OK: 0, SEND_FAILED: 0, SEND_BLOCKED: 0})
+                counts[SEND_BLOCKED if result in UNDELIVERABLE else result] += 1
+        async with db_transaction() as conn:
+            await execute_query(SQL_OUTBOX_FINISH, [row["id"] for row in rows], statuses, retry_at, now, conn=conn)
+            if unreachable:
+                # Личный чат: chat_id совпадает с user_id
+                await execute_query(
+                    SQL_MARK_UNDELIVERABLE, list(unreachable), list(unreachable.values()), conn=conn
+                )
+            if totals:
+                await execute_query(
+                    SQL_OUTBOX_RUN_TOTALS,
+                    [job for job, _ in totals], [run_key for _, run_key in totals],
+                    [counts[SEND_OK] for counts in totals.values()],
+                    [counts[SEND_FAILED] for counts in totals.values()],
+                    [counts[SEND_BLOCKED] for counts in totals.values()],
+                    conn=conn
+                )
+
+    async def _worker(self, stopping):
+        current_operation.set("outbox")
+        while not stopping.is_set():
+            try:
+                rows = await self.claim()
+                if rows:
+                    await self.deliver(rows)
+                    continue
+            except Exception as exc:
+                # Недописанные строки вернутся в очередь, когда истечёт аренда
+                print(f"Outbox worker error: {exc}")
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), OUTBOX_POLL_INTERVAL)
+
+    def report(self):
+        stats = self.broadcaster.stats
+        if stats.sent or stats.failed or stats.blocked:
+            stats.report()
+        self.broadcaster.stats = BroadcastStats(stats.job)
+
+    async def close(self):
+        await self.stop()
+        self.report()
+
+outbox_dispatcher = None
+
+async def report_outbox():
+    if outbox_dispatcher is not None:
+        outbox_dispatcher.report()
+    backlog = await fetch_value("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+    if backlog:
+        print(f"📮 Outbox backlog: {backlog} messages")
+
+async def cleanup_outbox():
+    cutoff = datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)
+    status = await execute_query("DELETE FROM outbox WHERE status <> 'pending' AND finished_at < $1", cutoff)
+    if affected_rows(status):
+        print(f"🧹 Removed {affected_rows(status)} delivered outbox messages")
+
+# === РАССЫЛКИ: ПОТОКОВАЯ АУДИТОРИЯ ===
+BROADCAST_MAX_INFLIGHT_CHUNKS = int(os.getenv("BROADCAST_MAX_INFLIGHT_CHUNKS", "2"))
+
+async def stream_audience(query, *params, chunk_size=None):
+    # Серверный курсор: в памяти не больше одной пачки, первые сообщения уходят сразу
+    chunk_size = chunk_size or BROADCAST_CHUNK_SIZE
+    async with db_transaction() as conn:
+        cursor = await conn.cursor(query, *params)
+        while True:
+            rows = await cursor.fetch(chunk_size)
+            if not rows:
+                break
+            yield [row["user_id"] for row in rows]
+
+# Аудитория всегда идёт по возрастанию user_id: это и есть контрольная точка запуска
+SQL_AUDIENCE_AFTER = """
+    SELECT user_id FROM ({audience_query}) AS audience
+    WHERE user_id > ${hwm_param}
+    ORDER BY user_id
+"""
+
+# Контрольная точка только растёт: отставший исполнитель не откатит её назад
+SQL_CHECKPOINT_RUN = named_sql("checkpoint_run", """
+    UPDATE broadcast_runs
+    SET last_user_id = $3, queued = queued + $4
+    WHERE job = $1 AND run_key = $2 AND (last_user_id IS NULL OR last_user_id < $3)
+""")
+
+MIN_USER_ID = -2 ** 63
+
+@asynccontextmanager
+async def claim_run(job, run_key):
+    # Один запуск — один исполнитель: сессионная advisory-блокировка на всё время рассылки.
+    # Соединение держим из пула; при возврате asyncpg снимает блокировки сам (pg_advisory_unlock_all),
+    # а если процесс умер — их снимает Postgres вместе с сессией
+    async with db_connection() as conn:
+        claimed = await conn.fetchval(
+            "SELECT pg_try_advisory_lock(hashtext('broadcast_runs'), hashtext($1))", f"{job}:{run_key}"
+        )
+        try:
+            yield claimed
+        finally:
+            if claimed and not conn.is_closed():
+                with suppress(Exception):
+                    await conn.execute(
+                        "SELECT pg_advisory_unlock(hashtext('broadcast_runs'), hashtext($1))", f"{job}:{run_key}"
+                    )
+
+async def start_run(job, run_key):
+    # Возвращает контрольную точку или None, если этот запуск уже завершён
+    row = await fetch_one("""
+        INSERT INTO broadcast_runs (job, run_key) VALUES ($1, $2)
+        ON CONFLICT (job, run_key) DO UPDATE SET job = EXCLUDED.job
+        RETURNING finished_at, last_user_id
+    """, job, run_key)
+    if row["finished_at"] is not None:
+        return None
+    return MIN_USER_ID if row["last_user_id"] is None else row["last_user_id"]
+
+async def run_broadcast(job: str, audience_query, params, plan_chunk, record_chunk=None, run_key=None,
+                        priority=OUTBOX_PRIORITY_LOW):
+    # Рассылка только ставит сообщения в outbox — это секунды даже на всю базу.
+    # Конвейер: чтение аудитории и планирование следующих пачек идут, пока текущая вставляется.
+    # plan_chunk(user_ids) -> [(OutgoingMessage, token)]; в одной транзакции со вставкой
+    # вызывается record_chunk(tokens, conn) и пишется контрольная точка.
+    if run_key is None:
+        return await _run_broadcast(job, audience_query, params, plan_chunk, record_chunk, None, priority,
+                                    MIN_USER_ID)
+    async with claim_run(job, run_key) as claimed:
+        if not claimed:
+            print(f"⏭ {job} {run_key} is already running elsewhere, skipping")
+            return 0
+        high_water_mark = await start_run(job, run_key)
+        if high_water_mark is None:
+            print(f"⏭ {job} {run_key} already finished, skipping")
+            return 0
+        if high_water_mark != MIN_USER_ID:
+            print(f"↩️ Resuming {job} {run_key} after user {high_water_mark}")
+        return await _run_broadcast(job, audience_query, params, plan_chunk, record_chunk, run_key, priority,
+                                    high_water_mark)
+
+async def _run_broadcast(job, audience_query, params, plan_chunk, record_chunk, run_key, priority,
+                         high_water_mark):
+    current_operation.set(f"job {job}")
+    query = SQL_AUDIENCE_AFTER.format(audience_query=audience_query, hwm_param=len(params) + 1)
+    started = time.perf_counter()
+    queued = 0
+    planned = asyncio.Queue(maxsize=BROADCAST_MAX_INFLIGHT_CHUNKS)
+
+    async def produce():
+        async with aclosing(stream_audience(query, *params, high_water_mark)) as chunks:
+            async for user_ids in chunks:
+                await planned.put((user_ids, await plan_chunk(user_ids)))
+        await planned.put(None)
+
+    async def enqueue():
+        # Один потребитель: пачки вставляются по порядку, контрольная точка только растёт
+        nonlocal queued
+        while True:
+            item = await planned.get()
+            if item is None:
+                break
+            user_ids, batch = item
+            async with db_transaction() as conn:
+                await enqueue_messages(
+                    [message for message, _ in batch], job,
+                    priority=priority, run_key=run_key, conn=conn
+                )
+                if record_chunk is not None:
+                    await record_chunk([token for _, token in batch], conn)
+                if run_key is not None:
+                    status = await execute_query(
+                        SQL_CHECKPOINT_RUN, job, run_key, user_ids[-1], len(batch), conn=conn
+                    )
+                    if not affected_rows(status):
+                        # Другой исполнитель ушёл дальше — откатываем пачку, чтобы не отправить её дважды
+                        raise RuntimeError(f"{job} {run_key}: checkpoint moved past user {user_ids[-1]}")
+            queued += len(batch)
+            broadcast_queued.inc(job, amount=len(batch))
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(produce())
+        group.create_task(enqueue())
+    if run_key is not None:
+        await execute_query(
+            "UPDATE broadcast_runs SET finished_at = $3 WHERE job = $1 AND run_key = $2",
+            job, run_key, datetime.utcnow()
+        )
+    broadcast_duration.observe(time.perf_counter() - started, job)
+    # Пустые корзины (частые при доставке по местному времени) в лог не пишем
+    if queued:
+        print(f"📥 {job}: queued {queued} messages")
+    return queued
+
+async def broadcast_text(job: str, audience_query, params, text, parse_mode=None, run_key=None):
+    async def plan_chunk(user_ids):
+        return [(OutgoingMessage(user_id, text, parse_mode), None) for user_id in user_ids]
+
+    return await run_broadcast(job, audience_query, params, plan_chunk, run_key=run_key)
+
+def today_run_key():
+    return datetime.now(pytz.timezone(DEFAULT_TIMEZONE)).date().isoformat()
+
+async def resume_broadcasts():
+    # После рестарта или смены лидера дописываем незавершённые запуски с контрольной точки
+    await execute_query("DELETE FROM broadcast_runs WHERE started_at < $1", datetime.utcnow() - timedelta(days=30))
+    rows = await fetch_all("""
+        SELECT job, run_key FROM broadcast_runs
+        WHERE finished_at IS NULL AND started_at > $1
+        ORDER BY started_at
+    """, datetime.utcnow() - timedelta(days=1))
+    for row in rows:
+        job = RESUMABLE_JOBS.get(row["job"])
+        if job is None:
+            continue
         try:
-            text = await get_unique_affirmation(user["user_id"])
-            await bot.send_message(user["user_id"], f"{prefix}{text}")
+            await job(run_key=row["run_key"])
         except Exception as exc:
-            print(f"{log_label} send error: {exc}")
+            print(f"Resume of {row['job']} {row['run_key']} failed: {exc}")
 
-async def send_daily_affirmation(bot: Bot):
-    await _send_affirmations(bot, "☀️ ", "Daily affirmation")
+# === ЕЖЕДНЕВНЫЕ АФФИРМАЦИИ ===
+async def _send_affirmations(prefix: str, log_label: str):
+    await _broadcast_content("affirmations", prefix + "{}", log_label)
+
+async def send_daily_affirmation():
+    await _send_affirmations("☀️ ", "Daily affirmation")
 
-async def send_morning_affirmations(bot: Bot):
-    await send_daily_affirmation(bot)
+async def send_morning_affirmations():
+    await send_daily_affirmation()
 
 # === ВЕЧЕРНИЕ ВОПРОСЫ ===
-async def _send_evening_questions(bot: Bot, log_label: str):
-    users = await execute_query("SELECT user_id FROM users")
-    for user in users:
-        try:
-            question = await get_unique_question(user["user_id"])
-            await bot.send_message(user["user_id"], f"🌙 {question}")
-        except Exception as exc:
-            print(f"{log_label} send error: {exc}")
+async def _send_evening_questions(log_label: str):
+    await _broadcast_content("evening_questions", "🌙 {}", log_label)
 
-async def send_evening_question(bot: Bot):
-    await _send_evening_questions(bot, "Evening question")
+async def send_evening_question():
+    await _send_evening_questions("Evening question")
 
-async def send_evening_questions(bot: Bot):
-    await send_evening_question(bot)
+async def send_evening_questions():
+    await send_evening_question()
 
 # === НАПОМИНАНИЕ «ДЫХАНИЕ ДНЕВНИКА» ===
-async def send_breathing_reminder(bot: Bot):
+# Диапазон по индексу users(last_entry_at) вместо анти-джойна с entries
+SQL_INACTIVE_USERS = f"""
+    SELECT user_id FROM users
+    WHERE (last_entry_at <= $1 OR last_entry_at IS NULL) AND {REACHABLE_USERS}
+"""
+
+async def send_breathing_reminder(run_key=None):
     week_ago = datetime.utcnow() - timedelta(days=7)
-    users = await execute_query("""
-        SELECT u.user_id FROM users u
-        LEFT JOIN entries e ON u.user_id = e.user_id AND e.created_at > $1
-        WHERE e.user_id IS NULL
-    """, week_ago)
-    
-    for user in users:
-        try:
-            await bot.send_message(
-                user["user_id"],
-                "Я здесь. Ты можешь писать — или просто быть.\n"
-                "Дневник дышит вместе с тобой. 🌙"
-            )
-        except Exception:
-            pass
-
-# === ГОДОВЩИНА ===
-async def send_anniversary(bot: Bot):
-    today = datetime.utcnow().date()
-    users = await execute_query("""
-        SELECT user_id FROM users 
-        WHERE DATE(created_at) = $1
-    """, today)
-    
-    for user in users:
-        try:
-            await bot.send_message(
-                user["user_id"],
-                "Ровно год назад ты открыл(а) этот дневник.\n"
+    await broadcast_text(
+        "Breathing reminder", SQL_INACTIVE_USERS, (week_ago,),
+        "Я здесь. Ты можешь писать — или просто быть.\n"
+        "Дневник дышит вместе с тобой. 🌙",
+        run_key=run_key or today_run_key()
+    )
+
+# === ГОДОВЩИНЫ ===
+# Юбилеи ищем диапазонами по индексу users(created_at): по одному суточному окну
+# (в поясе бота) на каждую дату регистрации, которую сегодня пора отметить
+ANNIVERSARY_MAX_YEARS = int(os.getenv("ANNIVERSARY_MAX_YEARS", "25"))
+FIRST_MONTH_DAYS = 30
+
+SQL_SIGNED_UP_ON = f"""
+    SELECT u.user_id
+    FROM unnest($1::timestamp[], $2::timestamp[]) AS d(day_start, day_end)
+    JOIN users u ON u.created_at >= d.day_start AND u.created_at < d.day_end
+    WHERE {REACHABLE_USERS}
+"""
+
+SQL_SIGNUP_TIMES = named_sql(
+    "signup_times", "SELECT user_id, created_at FROM users WHERE user_id = ANY($1::bigint[])"
+)
+
+def local_day_bounds(days):
+    tz = pytz.timezone(DEFAULT_TIMEZONE)
+
+    def utc_midnight(day):
+        local = tz.localize(datetime.combine(day, datetime.min.time()))
+        return local.astimezone(pytz.utc).replace(tzinfo=None)
+
+    return [utc_midnight(day) for day in days], [utc_midnight(day + timedelta(days=1)) for day in days]
+
+def anniversary_days(today):
+    days = []
+    for years in range(1, ANNIVERSARY_MAX_YEARS + 1):
+        year = today.year - years
+        if (today.month, today.day) == (2, 29):
+            if calendar.isleap(year):
+                days.append(date(year, 2, 29))
+            continue
+        days.append(today.replace(year=year))
+        # Зарегистрировавшихся 29 февраля в невисокосный год поздравляем 28-го
+        if (today.month, today.day) == (2, 28) and calendar.isleap(year) and not calendar.isleap(today.year):
+            days.append(date(year, 2, 29))
+    return days
+
+async def send_anniversary(run_key=None):
+    run_key = run_key or today_run_key()
+    today = date.fromisoformat(run_key)
+    tz = pytz.timezone(DEFAULT_TIMEZONE)
+
+    async def plan_chunk(user_ids):
+        rows = await fetch_all(SQL_SIGNUP_TIMES, user_ids)
+        planned = []
+        for row in rows:
+            years = today.year - pytz.utc.localize(row["created_at"]).astimezone(tz).year
+            when = "Ровно год назад" if years == 1 else f"Ровно {years} {plural(years, 'год', 'года', 'лет')} назад"
+            planned.append((OutgoingMessage(
+                row["user_id"],
+                f"{when} ты открыл(а) этот дневник.\n"
                 "Спасибо, что остаёшься.\n"
                 "Твои слова — семена света. 🌱"
-            )
-        except Exception:
-            pass
+            ), None))
+        return planned
 
-# === ЕЖЕМЕСЯЧНАЯ БЛАГОДАРНОСТЬ ===
-async def send_monthly_gratitude(bot: Bot):
-    now = datetime.utcnow()
-    users = await execute_query("SELECT user_id FROM users")
-    for user in users:
-        try:
-            await bot.send_message(
-                user["user_id"],
-                "Ты здесь уже целый месяц. 💛\n\n"
-                "Если дневник стал тебе дорог — ты можешь поддержать его.\n"
-                "Это не обязанность, а тёплые обнимашки для автора.\n\n"
-                "👉 <a href='https://tbank.ru/cf/59baQBY0btD'>Отправить их можно здесь</a>",
-                parse_mode="HTML"
-            )
-        except Exception:
-            pass
+    await run_broadcast(
+        "Anniversary", SQL_SIGNED_UP_ON, local_day_bounds(anniversary_days(today)),
+        plan_chunk, run_key=run_key
+    )
+
+# === ПЕРВЫЙ МЕСЯЦ С ДНЕВНИКОМ ===
+# Не всей базе первого числа, а каждому — ровно через 30 дней после регистрации
+async def send_monthly_gratitude(run_key=None):
+    run_key = run_key or today_run_key()
+    today = date.fromisoformat(run_key)
+    await broadcast_text(
+        "Monthly gratitude", SQL_SIGNED_UP_ON, local_day_bounds([today - timedelta(days=FIRST_MONTH_DAYS)]),
+        "Ты здесь уже целый месяц. 💛\n\n"
+        "Если дневник стал тебе дорог — ты можешь поддержать его.\n"
+        "Это не обязанность, а тёплые обнимашки для автора.\n\n"
+        "👉 <a href='https://tbank.ru/cf/59baQBY0btD'>Отправить их можно здесь</a>",
+        parse_mode="HTML",
+        run_key=run_key
+    )
+
+# Ежедневные рассылки с контрольной точкой. Аффирмации и вопросы сюда не входят:
+# их идемпотентность обеспечивает next_*_at, недоставленные попадут в следующую корзину.
+RESUMABLE_JOBS = {
+    "Breathing reminder": send_breathing_reminder,
+    "Anniversary": send_anniversary,
+    "Monthly gratitude": send_monthly_gratitude,
+}
 
 # === SCHEDULER ===
 
 scheduler = None  # важно: глобальная ссылка
 
-def setup_scheduler(bot: Bot):
+def setup_scheduler():
     global scheduler
 
-    moscow_tz = pytz.timezone(os.getenv("TIMEZONE", "Europe/Moscow"))
+    moscow_tz = pytz.timezone(DEFAULT_TIMEZONE)
     scheduler = AsyncIOScheduler(timezone=moscow_tz)
 
+    # Рассылки добавляются на паузе: их включает только лидер (см. scheduler_leader)
+    # Каждые несколько минут — только те, у кого сейчас наступило местное 08:00 / 20:00
     scheduler.add_job(
-        send_daily_affirmation,
-        CronTrigger(hour=8, minute=0),
-        args=[bot]
+        leader_job(send_daily_affirmation),
+        IntervalTrigger(minutes=DELIVERY_WINDOW_MINUTES),
+        id="daily_affirmation",
+        next_run_time=None
     )
 
     scheduler.add_job(
-        send_evening_question,
-        CronTrigger(hour=20, minute=0),
-        args=[bot]
+        leader_job(send_evening_question),
+        IntervalTrigger(minutes=DELIVERY_WINDOW_MINUTES),
+        id="evening_question",
+        next_run_time=None
     )
 
     scheduler.add_job(
-        send_breathing_reminder,
+        leader_job(send_breathing_reminder),
         CronTrigger(hour=10, minute=0),
-        args=[bot]
+        id="breathing_reminder",
+        next_run_time=None
     )
 
     scheduler.add_job(
-        send_anniversary,
+        leader_job(send_anniversary),
         CronTrigger(hour=12, minute=0),
-        args=[bot]
+        id="anniversary",
+        next_run_time=None
     )
 
     scheduler.add_job(
-        send_monthly_gratitude,
-        CronTrigger(day=1, hour=9, minute=0),
-        args=[bot]
+        leader_job(send_monthly_gratitude),
+        CronTrigger(hour=9, minute=0),
+        id="monthly_gratitude",
+        next_run_time=None
+    )
+
+    # Запуск, прерванный на прежнем лидере, мог быть ещё занят в момент смены лидерства —
+    # подбираем такие периодически (занятые пропускаются по блокировке запуска)
+    scheduler.add_job(
+        leader_job(resume_broadcasts),
+        IntervalTrigger(minutes=BROADCAST_RESUME_INTERVAL),
+        id="resume_broadcasts",
+        next_run_time=None
+    )
+
+    # Здоровье пула и outbox — у каждой реплики своё, работает всегда
+    scheduler.add_job(
+        report_db_health,
+        IntervalTrigger(seconds=DB_HEALTH_CHECK_INTERVAL)
+    )
+
+    scheduler.add_job(
+        report_outbox,
+        IntervalTrigger(seconds=OUTBOX_REPORT_INTERVAL)
+    )
+
+    scheduler.add_job(
+        cleanup_outbox,
+        IntervalTrigger(hours=1)
+    )
+
+    scheduler.add_job(
+        end_expired_silences,
+        IntervalTrigger(minutes=DELIVERY_WINDOW_MINUTES)
     )
 
     scheduler.start()
     print("✅ APScheduler started")
 
 
+# === ВЫБОР ЛИДЕРА ===
+# Каждая реплика поднимает свой планировщик, но рассылки выполняет только одна —
+# та, что держит сессионную advisory-блокировку. Блокировка живёт на отдельном
+# соединении вне пула: если процесс умер или связь с базой оборвалась, Postgres
+# снимет её сам, и лидерство перейдёт к следующей реплике.
+
+LEADER_LOCK_NAME = os.getenv("LEADER_LOCK_NAME", "luminary-scheduler")
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", 15))
+BROADCAST_RESUME_INTERVAL = int(os.getenv("BROADCAST_RESUME_INTERVAL", "10"))
+LEADER_JOBS = (
+    "daily_affirmation", "evening_question", "breathing_reminder", "anniversary", "monthly_gratitude",
+    "resume_broadcasts",
+)
+
+is_leader = False
+leader_tasks = set()  # выполняющиеся сейчас задания лидера
+
+def leader_job(func):
+    # Пауза в APScheduler останавливает только будущие запуски. Уже идущую рассылку при потере
+    # лидерства отменяем: новый лидер продолжит её с контрольной точки, а не параллельно с нами
+    @functools.wraps(func)
+    async def run(*args, **kwargs):
+        task = asyncio.current_task()
+        leader_tasks.add(task)
+        try:
+            return await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            if is_leader:
+                raise
+            print(f"⏹ {func.__name__} cancelled: scheduler leadership lost")
+        finally:
+            leader_tasks.discard(task)
+    return run
+
+def set_leader_jobs(active: bool):
+    global is_leader
+    is_leader = active
+    for job_id in LEADER_JOBS:
+        if active:
+            scheduler.resume_job(job_id)
+        else:
+            scheduler.pause_job(job_id)
+    if not active:
+        for task in list(leader_tasks):
+            task.cancel()
+    # Доставка из outbox — тоже только на лидере: лимит Telegram общий на весь токен
+    if outbox_dispatcher is not None:
+        if active:
+            outbox_dispatcher.start()
+        else:
+            asyncio.create_task(outbox_dispatcher.stop())
+
+async def scheduler_leader():
+    conn = None
+    try:
+        while True:
+            try:
+                if is_leader:
+                    # Оборванное соединение значит, что блокировка уже может быть у другого
+                    if conn.is_closed():
+                        raise asyncpg.ConnectionDoesNotExistError("leader connection closed")
+                    await conn.fetchval("SELECT 1", timeout=LEADER_CHECK_INTERVAL)
+                else:
+                    if conn is None or conn.is_closed():
+                        conn = await asyncpg.connect(DATABASE_URL, timeout=DB_ACQUIRE_TIMEOUT)
+                    if await conn.fetchval(
+                        "SELECT pg_try_advisory_lock(hashtext($1))", LEADER_LOCK_NAME,
+                        timeout=LEADER_CHECK_INTERVAL
+                    ):
+                        set_leader_jobs(True)
+                        print("👑 This replica is now the scheduler leader")
+                        # Прежний лидер мог упасть посреди рассылки — дописываем её
+                        asyncio.create_task(leader_job(resume_broadcasts)())
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+                if is_leader:
+                    set_leader_jobs(False)
+                    print(f"⚠️ Lost scheduler leadership: {exc}")
+                else:
+                    print(f"Leader election failed: {exc}")
+                if conn is not None:
+                    conn.terminate()
+                    conn = None
+            await asyncio.sleep(LEADER_CHECK_INTERVAL)
+    finally:
+        if is_leader:
+            set_leader_jobs(False)
+        if conn is not None:
+            # Закрытие сессии отпускает блокировку сразу, не дожидаясь таймаута
+            await conn.close()
+
+
+# === ПРОВЕРКА ИНДЕКСОВ ===
+# Горячие запросы и таблицы, которые они не должны читать последовательным сканом
+HOT_QUERIES = {
+    "entries_page_latest": (SQL_PAGE_LATEST, (1, "free", 21)),
+    "entries_page_older": (SQL_PAGE_OLDER, (1, "free", datetime(2000, 1, 1), 1, 21)),
+    "entries_page_newer": (SQL_PAGE_NEWER, (1, "free", datetime(2000, 1, 1), 1, 21)),
+    "summary": (SQL_SUMMARY, (1, "Europe/Moscow")),
+    "inactive_users": (SQL_INACTIVE_USERS, (datetime(2000, 1, 1),)),
+    "signed_up_on": (SQL_SIGNED_UP_ON, ([datetime(2000, 1, 1)], [datetime(2000, 1, 2)])),
+    "expired_silences": (
+        SQL_END_SILENCE.format(condition="silence_until <= $1"),
+        (datetime(2000, 1, 1), "Europe/Moscow", AFFIRMATION_LOCAL_TIME, QUESTION_LOCAL_TIME)
+    ),
+    "rotation_cursors": (SQL_LOAD_CURSORS, ("affirmations", [1])),
+    "due_affirmations": (SQL_DUE_USERS.format(due_column="next_affirmation_at"), (datetime(2000, 1, 1),)),
+    "due_questions": (SQL_DUE_USERS.format(due_column="next_question_at"), (datetime(2000, 1, 1),)),
+    "outbox_claim": (SQL_OUTBOX_CLAIM, (50, datetime(2000, 1, 1), datetime(2000, 1, 1))),
+}
+INDEXED_TABLES = {"entries", "content_cursors", "users", "outbox", "user_stats"}
+
+def _find_seq_scans(plan):
+    scans = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in INDEXED_TABLES:
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(_find_seq_scans(child))
+    return scans
+
+async def check_index_usage():
+    # На маленькой базе планировщик честно выберет seq scan, поэтому запрещаем его
+    # и проверяем, что для каждого запроса вообще существует индексный план
+    problems = {}
+    async with db_transaction() as conn:
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        for name, (query, params) in HOT_QUERIES.items():
+            explained = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *params)
+            plan = json.loads(explained)[0]["Plan"]
+            scans = _find_seq_scans(plan)
+            if scans:
+                problems[name] = scans
+    return problems
+
+async def check_indexes_command():
+    await init_pool()
+    try:
+        await init_db()
+        problems = await check_index_usage()
+    finally:
+        await close_pool()
+    for name, tables in problems.items():
+        print(f"❌ {name}: sequential scan on {', '.join(tables)}")
+    if not problems:
+        print(f"✅ All {len(HOT_QUERIES)} hot queries use indexes")
+    return 1 if problems else 0
+
+async def check_activity_command():
+    await init_pool()
+    try:
+        await init_db()
+        drift = await fetch_all(SQL_ACTIVITY_DRIFT)
+    finally:
+        await close_pool()
+    for row in drift[:20]:
+        print(
+            f"❌ user {row['user_id']}: last_entry_at {row['last_entry_at']} != {row['actual_last_entry_at']}, "
+            f"entry_count {row['entry_count']} != {row['actual_entry_count']}"
+        )
+    if drift:
+        print(f"{len(drift)} users out of sync, run `python main.py repair-activity`")
+    else:
+        print("✅ Activity counters match entries")
+    return 1 if drift else 0
+
+async def repair_activity_command():
+    await init_pool()
+    try:
+        await init_db()
+        status = await execute_query(SQL_REPAIR_ACTIVITY)
+    finally:
+        await close_pool()
+    print(f"🔧 Repaired activity counters for {affected_rows(status)} users")
+    return 0
+
+async def rebuild_stats_command():
+    await init_pool()
+    try:
+        await init_db()
+        async with db_transaction() as conn:
+            await rebuild_user_stats(conn)
+            total = await fetch_value("SELECT COUNT(*) FROM user_stats", conn=conn)
+    finally:
+        await close_pool()
+    print(f"🔧 Rebuilt statistics for {total} users")
+    return 0
+
+COMMANDS = {
+    "check-indexes": check_indexes_command,
+    "check-activity": check_activity_command,
+    "repair-activity": repair_activity_command,
+    "rebuild-stats": rebuild_stats_command,
+}
+
+# === WEB SERVER ===
+# Одно aiohttp-приложение в основном event loop: /health, админка и (в режиме webhook) вебхук Telegram
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+PORT = int(os.getenv("PORT", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# true — ответить Telegram сразу и обработать апдейт фоновой задачей, false — внутри запроса
+WEBHOOK_HANDLE_IN_BACKGROUND = os.getenv("WEBHOOK_HANDLE_IN_BACKGROUND", "true").lower() == "true"
+
+async def health_check(request):
+    return web.Response(text="OK")
+
+def check_admin_token(request):
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.headers.get("X-Admin-Token") != admin_token:
+        raise web.HTTPForbidden()
+
+async def admin_reload_catalog(request):
+    check_admin_token(request)
+    if not reload_catalogs():
+        raise web.HTTPInternalServerError(text="catalog reload failed, see logs")
+    return web.json_response({
+        name: {"version": catalog.version, "size": len(catalog)}
+        for name, catalog in content_catalogs.items()
+    })
+
+async def admin_stats(request):
+    check_admin_token(request)
+    delivery = await fetch_all("SELECT delivery_status, COUNT(*) AS users FROM users GROUP BY 1")
+    return web.json_response({
+        "db_pool": get_pool_stats(),
+        "profile_cache": get_profile_cache_stats(),
+        "delivery_status": {row["delivery_status"]: row["users"] for row in delivery},
+        "queries": get_query_profile(),
+    })
+
+async def metrics(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise web.HTTPForbidden()
+    return web.Response(
+        body=(await render_metrics()).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+def create_web_app(dp: Dispatcher = None, bot: Bot = None):
+    app = web.Application()
+    app.router.add_get('/health', health_check)
+    app.router.add_post('/admin/reload-catalog', admin_reload_catalog)
+    app.router.add_get('/admin/stats', admin_stats)
+    app.router.add_get('/metrics', metrics)
+    if dp is not None:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=WEBHOOK_HANDLE_IN_BACKGROUND,
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def start_web_server(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    await site.start()
+    return runner
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode")
+    runner = await start_web_server(create_web_app(dp, bot))
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    print(f"🌐 Webhook is listening on port {PORT}")
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    runner = await start_web_server(create_web_app())
+    try:
+        # Оставшийся от режима webhook вебхук не даст получать апдейты через getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+
 # === MAIN ===
 async def main():
+    await init_pool()
     await init_db()
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=create_fsm_storage())
     dp.include_router(router)
-    setup_scheduler(bot)
-
-    print("🤍 Diary bot is running")
-    await dp.start_polling(bot)
+    global outbox_dispatcher, entry_batcher
+    # Воркеры outbox запускает scheduler_leader, когда реплика становится лидером
+    outbox_dispatcher = OutboxDispatcher(bot)
+    if ENTRY_BATCHING:
+        entry_batcher = EntryBatcher()
+        entry_batcher.start()
+    setup_scheduler()
+    leader_task = asyncio.create_task(scheduler_leader())
+    # kill -HUP <pid> перечитывает каталог контента без перезапуска
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_catalogs)
+
+    print(f"🤍 Diary bot is running ({BOT_MODE})")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+    finally:
+        leader_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await leader_task
+        if entry_batcher is not None:
+            await entry_batcher.close()
+        await outbox_dispatcher.close()
+        await close_pool()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in COMMANDS:
+            sys.exit(f"Unknown command {sys.argv[1]!r}, available: {', '.join(COMMANDS)}")
+        sys.exit(asyncio.run(COMMANDS[sys.argv[1]]()))
     asyncio.run(main())
\ No newline at end of file